@@ -1,4 +1,6 @@
-from . import app
+from . import app, db
+from ..jsonutils import jsonify
+from ..validation import bucket_name_is_valid
 
 
 @app.route('/')
@@ -36,6 +38,14 @@ def bucket(bucket_name):
     pass
 
 
+@app.route('/bucket/<bucket_name>/indexes')
+def bucket_indexes(bucket_name):
+    if not bucket_name_is_valid(bucket_name):
+        return jsonify(status='error',
+                       message='invalid bucket name'), 400
+    return jsonify(**db.db.index_report(bucket_name))
+
+
 @app.route('/bucket/<bucket_name>/upload', methods=['GET', 'POST'])
 def upload(bucket_name):
     pass
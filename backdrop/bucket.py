@@ -1,12 +1,14 @@
 import collections
 
-from . import response
+from . import metrics, response, timeutils
 from .errors import BackdropError, ValidationError
-from .validation import bucket_name_is_valid
+from .query import Query
+from .validation import bucket_name_is_valid, validate_partial_definition
 
 
 class Bucket(object):
-    def __init__(self, db, bucket_name, allow_raw_queries):
+    def __init__(self, db, bucket_name, allow_raw_queries,
+                 group_commit=None, spool=None, skip_unchanged=False):
         if not bucket_name_is_valid(bucket_name):
             raise InvalidBucketError(
                 'Bucket name "{0}" is not valid'.format(bucket_name))
@@ -14,21 +16,77 @@ class Bucket(object):
         self._db = db
         self._bucket_name = bucket_name
         self._allow_raw_queries = allow_raw_queries
+        self._group_commit = group_commit
+        self._spool = spool
+        self._skip_unchanged = skip_unchanged
 
     def store(self, records):
         if not isinstance(records, collections.Iterable):
             records = [records]
 
-        records = [record.add_updated_at() for record in records]
+        records = (record.add_updated_at() for record in records)
+        if self._skip_unchanged:
+            records = (record.add_hash() for record in records)
 
-        self._db.store(self._bucket_name, records)
+        if self._spool:
+            return self._spool.store(
+                self._db, self._bucket_name, records, self._store)
+        return self._store(records)
+
+    def _store(self, records):
+        if self._group_commit:
+            return self._group_commit.store(
+                self._db, self._bucket_name, records)
+
+        return store_batches(self._db, self._bucket_name, [records])[0]
 
     def query(self, query):
         if query.is_raw_query and not self.allow_raw_queries:
             raise ValidationError("querying for raw data is not allowed")
 
-        result = self._db.query(self._bucket_name, query)
+        with metrics.timer('database.query'):
+            result = self._db.query(self._bucket_name, query)
+
+        with metrics.timer('response.build'):
+            return self._build_response(query, result)
+
+    def define_partial(self, partial_name, definition):
+        if not bucket_name_is_valid(partial_name):
+            raise ValidationError(
+                'Partial query name "{0}" is not valid'.format(partial_name))
+
+        result = validate_partial_definition(definition)
+        if not result.is_valid:
+            raise ValidationError(result.message)
+
+        self._db.define_partial(
+            self._bucket_name, partial_name,
+            Query.create(period=definition.get('period'),
+                         group_by=definition.get('group_by')))
+        self._db.bump_version(self._bucket_name, timeutils.now())
+
+    def delete_partial(self, partial_name):
+        if not self._db.delete_partial(self._bucket_name, partial_name):
+            raise PartialNotFoundError(
+                'Partial query "{0}" does not exist'.format(partial_name))
+        self._db.bump_version(self._bucket_name, timeutils.now())
+
+    def query_partial(self, partial_name, query):
+        definition = self._db.partial_definition(
+            self._bucket_name, partial_name)
+        if definition is None:
+            raise PartialNotFoundError(
+                'Partial query "{0}" does not exist'.format(partial_name))
+
+        query = query._replace(**definition)
+        with metrics.timer('database.query_partial'):
+            result = self._db.query_partial(
+                self._bucket_name, partial_name, query)
+
+        with metrics.timer('response.build'):
+            return self._build_response(query, result)
 
+    def _build_response(self, query, result):
         if query.is_period_grouped_query:
             result = response.build_period_group_response(query, result)
         elif query.is_grouped_query:
@@ -36,13 +94,43 @@ class Bucket(object):
         elif query.is_period_query:
             result = response.build_period_response(query, result)
         else:
-            result = response.build_simple_response(result)
+            result = response.build_simple_response(query, result)
         return result
 
+    def version(self):
+        """The write generation and time of the last write to the bucket"""
+        return BucketVersion(*self._db.version(self._bucket_name))
+
+    @property
+    def name(self):
+        return self._bucket_name
+
     @property
     def allow_raw_queries(self):
         return self._allow_raw_queries
 
 
+def store_batches(db, bucket_name, batches):
+    """Store batches of records, bumping the version if any changed"""
+    changed = True
+    try:
+        with metrics.timer('database.store'):
+            counts = db.store_batches(bucket_name, batches)
+        changed = any(count['inserted'] or count['updated']
+                      for count in counts)
+        return counts
+    finally:
+        if changed:
+            db.bump_version(bucket_name, timeutils.now())
+
+
+BucketVersion = collections.namedtuple('BucketVersion',
+                                       'generation updated_at')
+
+
 class InvalidBucketError(BackdropError):
+    pass
+
+
+class PartialNotFoundError(BackdropError):
     pass
\ No newline at end of file
@@ -0,0 +1,224 @@
+"""Caches for rendered query responses
+
+Entries are keyed on the bucket's write generation as well as the query,
+so a write to a bucket makes all of its cached responses unreachable.
+"""
+import collections
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+def from_config(config):
+    backend = config.get('QUERY_CACHE')
+    if backend is None:
+        return NullCache()
+    if backend == 'memory':
+        return LRUCache(config['QUERY_CACHE_MAX_ENTRIES'],
+                        config['QUERY_CACHE_MAX_ENTRY_SIZE'],
+                        config['QUERY_CACHE_TTL'])
+    if backend == 'mmap':
+        return MmapCache(config['QUERY_CACHE_PATH'],
+                         config['QUERY_CACHE_MAX_ENTRIES'],
+                         config['QUERY_CACHE_MAX_ENTRY_SIZE'],
+                         config['QUERY_CACHE_TTL'])
+    raise ValueError('Unknown query cache "{0}"'.format(backend))
+
+
+def cache_key(bucket_name, generation, query, *extra):
+    """Return a digest identifying a query on a generation of a bucket"""
+    normalized = (bucket_name, generation, _normalize(query)) + extra
+    return hashlib.md5(repr(normalized)).digest()
+
+
+def _normalize(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(item) for item in value)
+    return value
+
+
+class NullCache(object):
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def stats(self):
+        return {'backend': None}
+
+
+class LRUCache(object):
+    """A least recently used cache private to this process
+
+    Without a max_entry_size or ttl, entries of any size are kept until
+    they are evicted.
+    """
+
+    def __init__(self, max_entries, max_entry_size=None, ttl=None):
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        self._max_entry_size = max_entry_size
+        self._ttl = ttl
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or \
+                    entry[0] is not None and entry[0] < time.time():
+                self._misses += 1
+                return None
+            self._entries[key] = entry
+            self._hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        if self._max_entry_size is not None and \
+                len(value) > self._max_entry_size:
+            return
+        expires_at = None if self._ttl is None else time.time() + self._ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires_at, value)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'pid': os.getpid(),
+                'entries': len(self._entries),
+                'hits': self._hits,
+                'misses': self._misses,
+            }
+
+
+class MmapCache(object):
+    """A cache in a memory mapped file shared by all worker processes
+
+    The file is split into fixed size slots and each key maps to a
+    single slot, so a new entry evicts whatever shared its slot. Values
+    that do not fit in a slot are not cached.
+
+    Writers take a file lock. Readers do not; each slot has a sequence
+    number that is odd while the slot is being written, and a read that
+    sees it change is retried. The file is named for its layout, so
+    processes configured with a different size use a different file.
+    """
+    _header = struct.Struct('<8sII')
+    _slot_header = struct.Struct('<Q16sdI')
+    _sequence = struct.Struct('<Q')
+    _magic = 'BDCACHE2'
+    _read_attempts = 3
+
+    def __init__(self, path, slots, slot_size, ttl):
+        self._slots = slots
+        self._slot_size = slot_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._path = '{0}.{1}x{2}'.format(path, slots, slot_size)
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._counts_lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+        size = self._header.size + slots * slot_size
+        with self._locked():
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, size)
+                self._map = mmap.mmap(self._fd, size)
+                self._header.pack_into(
+                    self._map, 0, self._magic, slots, slot_size)
+            elif os.fstat(self._fd).st_size == size:
+                self._map = mmap.mmap(self._fd, size)
+            else:
+                self._map = None
+
+            if self._map is None or self._header.unpack_from(self._map, 0) \
+                    != (self._magic, slots, slot_size):
+                # Another process may be using it, so it is not reset
+                raise ValueError(
+                    'Query cache file {0} has a different layout'.format(
+                        self._path))
+
+    def get(self, key):
+        value = self._read(self._slot_offset(key), key)
+        with self._counts_lock:
+            if value is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        return value
+
+    def set(self, key, value):
+        if len(value) > self._slot_size - self._slot_header.size:
+            return
+        offset = self._slot_offset(key)
+        with self._locked():
+            sequence = (self._sequence.unpack_from(self._map, offset)[0]
+                        + 2) & ~1
+            self._sequence.pack_into(self._map, offset, sequence - 1)
+            self._slot_header.pack_into(
+                self._map, offset, sequence - 1, key,
+                time.time() + self._ttl, len(value))
+            start = offset + self._slot_header.size
+            self._map[start:start + len(value)] = value
+            self._sequence.pack_into(self._map, offset, sequence)
+
+    def stats(self):
+        with self._counts_lock:
+            return {
+                'backend': 'mmap',
+                'pid': os.getpid(),
+                'path': self._path,
+                'slots': self._slots,
+                'hits': self._hits,
+                'misses': self._misses,
+            }
+
+    def _read(self, offset, key):
+        for _ in range(self._read_attempts):
+            sequence, slot_key, expires_at, length = \
+                self._slot_header.unpack_from(self._map, offset)
+            if sequence % 2:
+                continue
+            if slot_key != key or expires_at < time.time():
+                value = None
+            else:
+                start = offset + self._slot_header.size
+                length = min(length, self._slot_size - self._slot_header.size)
+                value = self._map[start:start + length]
+            if self._sequence.unpack_from(self._map, offset)[0] == sequence:
+                return value
+        return None
+
+    def _slot_offset(self, key):
+        slot = struct.unpack('<Q', key[:8])[0] % self._slots
+        return self._header.size + slot * self._slot_size
+
+    def _locked(self):
+        return _FileLock(self._fd, self._lock)
+
+
+class _FileLock(object):
+    """Exclude other threads and, with a POSIX lock, other processes"""
+
+    def __init__(self, fd, lock):
+        self._fd = fd
+        self._lock = lock
+
+    def __enter__(self):
+        self._lock.acquire()
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
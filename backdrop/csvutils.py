@@ -4,40 +4,43 @@ from .errors import ParseError
 
 
 def parse(incoming_data):
-    print(incoming_data)
-    return list(
-        parse_rows(
-            ignore_comment_column(unicode_csv_dict_reader(
-                ignore_comment_lines(incoming_data), 'utf-8')
-            )
-        )
-    )
+    """Lazily parse rows from an iterable of CSV lines"""
+    reader = unicode_csv_dict_reader(
+        ignore_comment_lines(incoming_data), 'utf-8')
+    return ignore_empty_rows(ignore_comment_column(check_rows(reader)))
 
 
 def is_empty_row(row):
     return all(not v for v in row.values())
 
 
-def parse_rows(data):
-    for datum in data:
+def check_rows(reader):
+    for datum in reader:
         if None in datum.keys():
             raise ParseError(
-                'Some rows ins the CSV file contain more values than columns')
+                'Line {0} of the CSV file contains more values than '
+                'columns'.format(reader.line_num))
         if None in datum.values():
             raise ParseError(
-                'Some rows in the CSV file contain fewer values than columns')
+                'Line {0} of the CSV file contains fewer values than '
+                'columns'.format(reader.line_num))
+        yield datum
+
+
+def ignore_empty_rows(data):
+    for datum in data:
         if not is_empty_row(datum):
             yield datum
 
 
 def ignore_comment_lines(reader):
+    # Comment lines are blanked rather than dropped so the reader still
+    # counts them in line_num
     for line in reader:
-        if not line.startswith('#'):
-            yield line
+        yield '\n' if line.startswith('#') else line
 
 
 def ignore_comment_column(data):
-    data = list(data)
     for d in data:
         if "comment" in d:
             del d["comment"]
@@ -50,10 +53,14 @@ class UnicodeCsvReader(object):
         self._encoding = encoding
 
     def next(self):
+        row = self._reader.next()
+        while not row:
+            row = self._reader.next()
         try:
-            return [self._decode(cell) for cell in self._reader.next()]
+            return [self._decode(cell) for cell in row]
         except UnicodeError:
-            raise ParseError("Non-UTF8 characters found.")
+            raise ParseError("Non-UTF8 characters found on line {0}."
+                             .format(self.line_num))
 
     @property
     def line_num(self):
@@ -0,0 +1,474 @@
+"""Aggregations of the values of a field in each group
+
+`collect=field` gives the distinct values of a field and
+`collect=field:method` a single aggregate of them, under the name
+"field:method". The database computes each aggregation in a state that
+can be merged, so groups can be combined into their parent groups, and
+the state is turned into the value returned once merging is done.
+"""
+import json
+import math
+import re
+
+
+METHODS = ['sum', 'mean', 'min', 'max', 'count_distinct']
+
+# p50, p95, p99.9 and so on
+PERCENTILE_RE = re.compile(r'^p(100|\d{1,2}(\.\d+)?)$')
+
+
+def is_method(method):
+    return method in METHODS or PERCENTILE_RE.match(method) is not None
+
+
+def parse(collect):
+    """Return the aggregations requested by a list of collect arguments"""
+    return [_parse_one(collect_me) for collect_me in collect]
+
+
+def _parse_one(collect_me):
+    field, _, method = collect_me.partition(':')
+    if PERCENTILE_RE.match(method):
+        return Percentile(field, collect_me, float(method[1:]))
+    return AGGREGATIONS[method or None](field, collect_me)
+
+
+def fields(collect):
+    """The fields of records that a list of collect arguments reads"""
+    return sorted(set(aggregation.field for aggregation in parse(collect)))
+
+
+def empty_values(collect, subgroups=False):
+    """The value of each aggregation for a group without records"""
+    return dict((aggregation.name, aggregation.value(
+                 aggregation.pop_state(aggregation.from_values([]))))
+                for aggregation in parse(collect)
+                if aggregation.in_subgroups or not subgroups)
+
+
+class Aggregation(object):
+    # Whether subgroups are given their own value as well as their group
+    in_subgroups = True
+
+    def __init__(self, field, name):
+        self.field = field
+        self.name = name
+        # The state is kept in the database under key, as field names
+        # cannot contain the '.' of names such as "field:p99.9"
+        self.key = name.replace('.', '_')
+
+    def accumulators(self):
+        """Accumulators for the $group stage of an aggregation pipeline"""
+        raise NotImplementedError
+
+    def initial(self):
+        """Initial state for the group command"""
+        raise NotImplementedError
+
+    def reducer(self):
+        """JavaScript adding `current` to the state in `previous`"""
+        raise NotImplementedError
+
+    def from_values(self, values):
+        """The state for a list of values, as the database returns it"""
+        raise NotImplementedError
+
+    def final_expression(self):
+        """An expression to replace the state with once the $group stage
+        is done, where the state will not be merged, or None"""
+        return None
+
+    def finalizer(self):
+        """JavaScript doing the same as final_expression to the state in
+        `out` of the group command, or None"""
+        return None
+
+    def pop_state(self, row):
+        return row.pop(self.key)
+
+    def merge(self, state, other):
+        raise NotImplementedError
+
+    def value(self, state):
+        return state
+
+    def _js(self, code):
+        return code.format(field=json.dumps(self.field),
+                           name=json.dumps(self.key))
+
+
+class Values(Aggregation):
+    """The distinct values of a field, sorted"""
+    in_subgroups = False
+
+    def accumulators(self):
+        return {self.key: {"$addToSet": "$" + self.field}}
+
+    def initial(self):
+        return {self.key: []}
+
+    def reducer(self):
+        return self._js("if (current[{field}] !== undefined) "
+                        "{{ previous[{name}].push(current[{field}]); }}")
+
+    def from_values(self, values):
+        return {self.key: list(set(values))}
+
+    def pop_state(self, row):
+        return set(row.pop(self.key))
+
+    def merge(self, state, other):
+        return state | other
+
+    def value(self, state):
+        return sorted(state)
+
+
+class CountDistinct(Values):
+    """The number of distinct values of a field"""
+    in_subgroups = True
+
+    def initial(self):
+        return {self.key: {}}
+
+    def reducer(self):
+        return self._js("var v = current[{field}]; "
+                        "if (v !== undefined) "
+                        "{{ previous[{name}][typeof v + ':' + v] = v; }}")
+
+    def final_expression(self):
+        return {"$size": "$" + self.key}
+
+    def finalizer(self):
+        return self._js("out[{name}] = Object.keys(out[{name}]).length;")
+
+    def pop_state(self, row):
+        state = row.pop(self.key)
+        if isinstance(state, (int, long)):
+            # Counted by the database
+            return state
+        if isinstance(state, dict):
+            state = state.values()
+        return set(state)
+
+    def value(self, state):
+        if isinstance(state, (int, long)):
+            return state
+        return len(state)
+
+
+class Sum(Aggregation):
+    """The sum of the numeric values of a field"""
+    def accumulators(self):
+        return {self.key: {"$sum": "$" + self.field}}
+
+    def initial(self):
+        return {self.key: 0}
+
+    def reducer(self):
+        return self._js("var v = current[{field}]; "
+                        "if (typeof v == 'number') "
+                        "{{ previous[{name}] += v; }}")
+
+    def from_values(self, values):
+        return {self.key: sum(_numbers(values))}
+
+    def merge(self, state, other):
+        return state + other
+
+
+class Mean(Aggregation):
+    """The mean of the numeric values of a field"""
+    def __init__(self, field, name):
+        super(Mean, self).__init__(field, name)
+        self._count_key = self.key + ':count'
+
+    def accumulators(self):
+        return {
+            self.key: {"$sum": "$" + self.field},
+            self._count_key: {"$sum": {
+                "$cond": [_is_number("$" + self.field), 1, 0]}},
+        }
+
+    def initial(self):
+        return {self.key: 0, self._count_key: 0}
+
+    def reducer(self):
+        return self._js("var v = current[{field}]; "
+                        "if (typeof v == 'number') "
+                        "{{ previous[{name}] += v; "
+                        "previous[{name} + ':count']++; }}")
+
+    def from_values(self, values):
+        numbers = list(_numbers(values))
+        return {self.key: sum(numbers), self._count_key: len(numbers)}
+
+    def pop_state(self, row):
+        return row.pop(self.key), row.pop(self._count_key)
+
+    def merge(self, state, other):
+        return state[0] + other[0], state[1] + other[1]
+
+    def value(self, state):
+        total, count = state
+        if count:
+            return float(total) / count
+
+
+class Min(Aggregation):
+    """The smallest numeric value of a field"""
+    _accumulator = "$min"
+    _operator = "<"
+    _choose = min
+
+    def accumulators(self):
+        field = "$" + self.field
+        return {self.key: {self._accumulator: {
+            "$cond": [_is_number(field), field, None]}}}
+
+    def initial(self):
+        return {self.key: None}
+
+    def reducer(self):
+        return self._js("var v = current[{field}]; "
+                        "if (typeof v == 'number' && "
+                        "(previous[{name}] === null || v " +
+                        self._operator + " previous[{name}])) "
+                        "{{ previous[{name}] = v; }}")
+
+    def from_values(self, values):
+        numbers = list(_numbers(values))
+        return {self.key: self._choose(numbers) if numbers else None}
+
+    def merge(self, state, other):
+        if state is None or other is None:
+            return other if state is None else state
+        return self._choose(state, other)
+
+
+class Max(Min):
+    """The largest numeric value of a field"""
+    _accumulator = "$max"
+    _operator = ">"
+    _choose = max
+
+
+class Percentile(Aggregation):
+    """A percentile of the numeric values of a field, from a Sketch
+
+    The group command builds the sketch in the database. The aggregate
+    engine counts the values in each bucket of the sketch with a
+    pipeline of its own, see `bucket_stages`, so it has no accumulators.
+    """
+    def __init__(self, field, name, percent):
+        super(Percentile, self).__init__(field, name)
+        self.percent = percent
+
+    def accumulators(self):
+        return {}
+
+    def initial(self):
+        return {self.key: Sketch().to_document()}
+
+    def reducer(self):
+        return self._js("var v = current[{field}]; "
+                        "if (typeof v == 'number' && isFinite(v)) {{ "
+                        "var s = previous[{name}]; s.count++; "
+                        "if (v == 0) {{ s.zero++; }} else {{ "
+                        "var b = v > 0 ? s.positive : s.negative; "
+                        "var i = String(Math.ceil("
+                        "Math.log(Math.abs(v)) / " + repr(Sketch.log_gamma) +
+                        ")); b[i] = (b[i] || 0) + 1; }} }}")
+
+    def from_values(self, values):
+        return {self.key: Sketch.of(_numbers(values)).to_document()}
+
+    def bucket_stages(self, group_id):
+        """Pipeline stages counting the values in each sketch bucket
+
+        group_id is the _id of the groups, to which the sign and bucket
+        index are added. Infinities and NaN are left out, as they are by
+        Sketch.add.
+        """
+        field = "$" + self.field
+        magnitude = {"$cond": [{"$lt": [field, 0]},
+                               {"$subtract": [0, field]}, field]}
+        group_id = dict(group_id, _sign={
+            "$cond": [{"$gt": [field, 0]}, 1,
+                      {"$cond": [{"$lt": [field, 0]}, -1, 0]}]})
+        group_id["_index"] = {"$cond": [{"$eq": [field, 0]}, 0,
+                                        _bucket_index(magnitude)]}
+        return [
+            {"$match": {self.field: {"$gt": float("-inf"),
+                                     "$lt": float("inf")}}},
+            {"$group": {"_id": group_id, "_count": {"$sum": 1}}},
+        ]
+
+    def pop_state(self, row):
+        return Sketch(row.pop(self.key))
+
+    def merge(self, state, other):
+        return state.merge(other)
+
+    def value(self, state):
+        return state.quantile(self.percent / 100)
+
+
+class Sketch(object):
+    """A mergeable summary of numbers that answers quantile queries
+
+    Numbers are counted in buckets whose bounds grow by a factor of
+    gamma, so a quantile is within `accuracy` of a number that was
+    added, relative to its size, however many numbers are added. Its
+    document is the count of numbers in each bucket, which is small,
+    can be stored and is merged by adding the counts.
+    """
+    accuracy = 0.01
+    gamma = (1 + accuracy) / (1 - accuracy)
+    log_gamma = math.log(gamma)
+
+    def __init__(self, document=None):
+        document = document or {}
+        self.count = int(document.get("count", 0))
+        self.zero = int(document.get("zero", 0))
+        self.positive = _int_keys(document.get("positive", {}))
+        self.negative = _int_keys(document.get("negative", {}))
+
+    @classmethod
+    def of(cls, numbers):
+        sketch = cls()
+        for number in numbers:
+            sketch.add(number)
+        return sketch
+
+    def add(self, number):
+        if math.isinf(number) or math.isnan(number):
+            return
+        if number == 0:
+            self.add_bucket(0, 0)
+        else:
+            self.add_bucket(1 if number > 0 else -1,
+                            self._index(abs(number)))
+
+    def add_bucket(self, sign, index, count=1):
+        """Count numbers of a sign in the bucket with index"""
+        self.count += count
+        if sign == 0:
+            self.zero += count
+        else:
+            buckets = self.positive if sign > 0 else self.negative
+            buckets[index] = buckets.get(index, 0) + count
+
+    def merge(self, other):
+        self.count += other.count
+        self.zero += other.zero
+        for buckets, others in [(self.positive, other.positive),
+                                (self.negative, other.negative)]:
+            for index, count in others.items():
+                buckets[index] = buckets.get(index, 0) + count
+        return self
+
+    def quantile(self, q):
+        """The number of rank q, from 0 to 1, or None if empty"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self._value(index)
+        seen += self.zero
+        if seen > rank:
+            return 0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._value(index)
+        return self._value(max(self.positive))
+
+    def to_document(self):
+        return {
+            "count": self.count,
+            "zero": self.zero,
+            "positive": _str_keys(self.positive),
+            "negative": _str_keys(self.negative),
+        }
+
+    def _index(self, magnitude):
+        return int(math.ceil(math.log(magnitude) / self.log_gamma))
+
+    def _value(self, index):
+        # The middle of the bucket, in relative terms
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+
+AGGREGATIONS = {
+    None: Values,
+    'sum': Sum,
+    'mean': Mean,
+    'min': Min,
+    'max': Max,
+    'count_distinct': CountDistinct,
+}
+
+
+def _numbers(values):
+    return (value for value in values
+            if isinstance(value, (int, long, float))
+            and not isinstance(value, bool))
+
+
+def _int_keys(counts):
+    return dict((int(index), int(count)) for index, count in counts.items())
+
+
+def _str_keys(counts):
+    # Documents can only have string keys
+    return dict((str(index), count) for index, count in counts.items())
+
+
+# Bits of the largest bucket index, that of the largest double
+_INDEX_BITS = 16
+
+
+def _bucket_index(magnitude):
+    """An expression for Sketch._index of a positive number
+
+    There is no logarithm operator, so floor(log_gamma(x)) of x >= 1 is
+    found a bit at a time, dividing x by gamma ** 2 ** bit while it is
+    larger. Each bit is a $let holding what is left of x and the bits
+    found so far. A magnitude below 1 has the negated index of its
+    inverse.
+    """
+    def step(bit):
+        x, found = "$$x{0}".format(bit + 1), "$$i{0}".format(bit + 1)
+        if bit < 0:
+            return {"$cond": [{"$gte": [magnitude, 1]},
+                              {"$cond": [{"$gt": [x, 1]},
+                                         {"$add": [found, 1]}, found]},
+                              {"$subtract": [0, found]}]}
+        bound = Sketch.gamma ** 2 ** bit
+        larger = {"$gte": [x, bound]}
+        return {"$let": {
+            "vars": {
+                "x{0}".format(bit): {
+                    "$cond": [larger, {"$divide": [x, bound]}, x]},
+                "i{0}".format(bit): {
+                    "$cond": [larger, {"$add": [found, 2 ** bit]}, found]},
+            },
+            "in": step(bit - 1)}}
+
+    return {"$let": {
+        "vars": {
+            "x{0}".format(_INDEX_BITS): {
+                "$cond": [{"$gte": [magnitude, 1]},
+                          magnitude, {"$divide": [1, magnitude]}]},
+            "i{0}".format(_INDEX_BITS): 0,
+        },
+        "in": step(_INDEX_BITS - 1)}}
+
+
+def _is_number(field):
+    # Numbers sort after null and before every string in BSON order
+    return {"$and": [{"$gt": [field, None]}, {"$lt": [field, ""]}]}
@@ -0,0 +1,381 @@
+"""An in-memory database driver
+
+Buckets are held as columns of values with a sorted _timestamp index and
+an index of rows by value for every other field. Queries run through the
+same Query and Collection as the MongoDB driver, so grouping, periods,
+sorting and collect behave identically. Data lives only as long as the
+process.
+"""
+import bisect
+import collections
+import datetime
+import os
+import threading
+
+import pytz
+from bson import ObjectId
+
+from . import aggregations
+from .mongodb import Query, Collection, skip_unchanged, \
+    COMPUTED_PERIOD_KEYS, grouping_field, group_partial, index_key
+
+
+class Database(object):
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['DATABASE_NAME'])
+
+    def __init__(self, name):
+        self.name = name
+        self._tables = collections.defaultdict(Table)
+        self._versions = {}
+        self._partials = {}
+        self._lock = threading.RLock()
+
+    def _collection(self, bucket_name):
+        return Collection(MemoryDriver(self._tables[bucket_name], self._lock))
+
+    def store(self, bucket_name, records):
+        return self.store_batches(bucket_name, [records])[0]
+
+    def store_batches(self, bucket_name, batches):
+        collection = self._collection(bucket_name)
+        counts = []
+        for batch in batches:
+            count = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+            for record in batch:
+                [(_, doc)] = skip_unchanged(collection,
+                                             [(0, record.to_dict())])
+                if doc is None:
+                    count['unchanged'] += 1
+                elif collection.save_all([doc])[0]:
+                    count['updated'] += 1
+                else:
+                    count['inserted'] += 1
+            counts.append(count)
+        return counts
+
+    def query(self, bucket_name, query):
+        return Query(query).execute(self._collection(bucket_name))
+
+    def bump_version(self, bucket_name, updated_at):
+        # Stored as naive UTC, as MongoDB returns it
+        if updated_at.tzinfo is not None:
+            updated_at = updated_at.astimezone(pytz.utc).replace(tzinfo=None)
+        with self._lock:
+            generation, _ = self.version(bucket_name)
+            self._versions[bucket_name] = (generation + 1, updated_at)
+
+    def version(self, bucket_name):
+        return self._versions.get(bucket_name, (0, None))
+
+    def partial_definition(self, bucket_name, partial_name):
+        return self._partials.get((bucket_name, partial_name))
+
+    def define_partial(self, bucket_name, partial_name, query):
+        self._partials[(bucket_name, partial_name)] = {
+            'period': query.period,
+            'group_by': query.group_by,
+        }
+
+    def delete_partial(self, bucket_name, partial_name):
+        return self._partials.pop((bucket_name, partial_name), None) \
+            is not None
+
+    def query_partial(self, bucket_name, partial_name, query):
+        """Group the raw records, which is cheap enough held in memory"""
+        return group_partial(
+            MemoryDriver(self._tables[bucket_name], self._lock), query)
+
+    def index_report(self, bucket_name):
+        return {
+            "indexes": self._tables[bucket_name].indexes(),
+            "missed_queries": [],
+        }
+
+    def connection_stats(self):
+        return {'pid': os.getpid(), 'connected': True}
+
+
+class Table(object):
+    """The records of a bucket held as columns
+
+    Row numbers index into every column. Fields a record does not have
+    hold MISSING. Replaced records are overwritten in place.
+    """
+    def __init__(self):
+        self._columns = {}
+        self._size = 0
+        self._rows_by_id = {}
+        self._value_indexes = collections.defaultdict(
+            lambda: collections.defaultdict(set))
+        self._timestamp_index = None
+
+    def save(self, doc):
+        """Save a document, returning True if it was inserted"""
+        doc = dict((key, _to_storage(value)) for key, value in doc.items())
+        if "_id" not in doc:
+            doc["_id"] = ObjectId()
+
+        row = self._rows_by_id.get(doc["_id"])
+        inserted = row is None
+        if inserted:
+            row = self._size
+            self._size += 1
+            for column in self._columns.values():
+                column.append(MISSING)
+            self._rows_by_id[doc["_id"]] = row
+        else:
+            self._unindex(row)
+
+        for field in set(self._columns) | set(doc):
+            if field not in self._columns:
+                self._columns[field] = [MISSING] * self._size
+            self._columns[field][row] = doc.get(field, MISSING)
+
+        self._index(row)
+        return inserted
+
+    def _index(self, row):
+        for field, column in self._columns.items():
+            if _is_indexable(field, column[row]):
+                self._value_indexes[field][column[row]].add(row)
+        self._timestamp_index = None
+
+    def _unindex(self, row):
+        for field, column in self._columns.items():
+            if _is_indexable(field, column[row]):
+                self._value_indexes[field][column[row]].discard(row)
+
+    def value(self, field, row):
+        column = self._columns.get(field)
+        return MISSING if column is None else column[row]
+
+    def rows_by_id(self, ids):
+        return [(_id, self._rows_by_id[_id])
+                for _id in ids if _id in self._rows_by_id]
+
+    def document(self, row, fields=None):
+        doc = {}
+        for field, column in self._columns.items():
+            if column[row] is not MISSING and \
+                    (fields is None or field in fields):
+                doc[field] = column[row]
+        return doc
+
+    def candidate_rows(self, spec):
+        """Rows that may match spec, narrowed with an index if possible"""
+        if "_timestamp" in spec and isinstance(spec["_timestamp"], dict):
+            rows = self._timestamp_range(spec["_timestamp"])
+            if rows is not None:
+                return rows
+
+        candidates = None
+        for field, condition in spec.items():
+            if field in self._value_indexes and \
+                    not isinstance(condition, (dict, list)):
+                rows = self._value_indexes[field].get(condition, ())
+                if candidates is None or len(rows) < len(candidates):
+                    candidates = rows
+        if candidates is not None:
+            return sorted(candidates)
+
+        return range(self._size)
+
+    def _timestamp_range(self, condition):
+        if not set(condition) & set(["$gte", "$gt", "$lt"]):
+            return None
+
+        timestamps, rows = self._sorted_timestamps()
+        start, end = 0, len(timestamps)
+        if "$gte" in condition:
+            start = bisect.bisect_left(timestamps, condition["$gte"])
+        if "$gt" in condition:
+            start = bisect.bisect_right(timestamps, condition["$gt"])
+        if "$lt" in condition:
+            end = bisect.bisect_left(timestamps, condition["$lt"])
+        return rows[start:end]
+
+    def _sorted_timestamps(self):
+        if self._timestamp_index is None:
+            column = self._columns.get("_timestamp", [])
+            rows = sorted((row for row in range(len(column))
+                           if isinstance(column[row], datetime.datetime)),
+                          key=column.__getitem__)
+            self._timestamp_index = ([column[row] for row in rows], rows)
+        return self._timestamp_index
+
+    def indexes(self):
+        return [{"name": "_timestamp", "key": [["_timestamp", 1]]}] + \
+            [{"name": field, "key": [[field, 1]]}
+             for field in sorted(self._value_indexes)]
+
+
+class MemoryDriver(object):
+    """Runs queries in the form MongoDriver takes against a Table"""
+
+    def __init__(self, table, lock):
+        self._table = table
+        self._lock = lock
+        self.sort_options = {
+            "ascending": False,
+            "descending": True
+        }
+
+    def find(self, query, sort, limit, fields=None):
+        with self._lock:
+            rows = self._matching_rows(query)
+            rows.sort(key=lambda row: (self._sort_key(sort[0], row),
+                                       self._sort_key("_id", row)),
+                      reverse=self.sort_options[sort[1]])
+            if limit:
+                rows = rows[:limit]
+            return [self._table.document(row, _projected(fields))
+                    for row in rows]
+
+    def group(self, keys, query, collect, sort=None, limit=None):
+        with self._lock:
+            for key in keys:
+                field = grouping_field(key)
+                if field not in query:
+                    query[field] = {"$ne": None}
+
+            fields = aggregations.fields(collect)
+            groups = collections.OrderedDict()
+            values = {}
+            for row in self._matching_rows(query):
+                key_values = [self._value(key, row) for key in keys]
+                group = index_key(key_values)
+                if group not in groups:
+                    groups[group] = dict(zip(keys, key_values), _count=0)
+                    values[group] = dict((field, []) for field in fields)
+                groups[group]["_count"] += 1
+                for field in fields:
+                    value = self._value(field, row)
+                    if value is not MISSING:
+                        values[group][field].append(value)
+
+            rows = []
+            for group, row in groups.items():
+                for aggregation in aggregations.parse(collect):
+                    row.update(aggregation.from_values(
+                        values[group][aggregation.field]))
+                rows.append(row)
+            return rows
+
+    def save_all(self, docs):
+        with self._lock:
+            return [not self._table.save(doc) for doc in docs]
+
+    def hashes(self, ids):
+        with self._lock:
+            return dict((_id, self._table.value('_hash', row))
+                        for _id, row in self._table.rows_by_id(ids))
+
+    def _value(self, field, row):
+        if field in COMPUTED_PERIOD_KEYS:
+            timestamp = self._table.value("_timestamp", row)
+            if not isinstance(timestamp, datetime.datetime):
+                return MISSING
+            return COMPUTED_PERIOD_KEYS[field].start(timestamp)
+        return self._table.value(field, row)
+
+    def _sort_key(self, field, row):
+        value = self._value(field, row)
+        return (_type_order(value), None if value is MISSING else value)
+
+    def _matching_rows(self, spec):
+        spec = _to_storage(spec)
+        return [row for row in self._table.candidate_rows(spec)
+                if self._matches(row, spec)]
+
+    def _matches(self, row, spec):
+        for field, condition in spec.items():
+            if field == "$or":
+                if not any(self._matches(row, branch)
+                           for branch in condition):
+                    return False
+            elif not _satisfies(self._value(field, row), condition):
+                return False
+        return True
+
+
+class _Missing(object):
+    def __repr__(self):
+        return 'MISSING'
+
+
+MISSING = _Missing()
+
+UNINDEXED = frozenset(["_id", "_timestamp", "_updated_at"])
+
+
+def _is_indexable(field, value):
+    # Lists and documents are not hashable, and only ever match
+    # conditions that are not looked up in the index
+    return field not in UNINDEXED and value is not MISSING and \
+        not isinstance(value, (list, dict))
+
+# The order MongoDB sorts values of different types in
+_TYPE_ORDER = [
+    (type(None), 1),
+    (bool, 8),
+    ((int, long, float), 2),
+    (basestring, 3),
+    (dict, 4),
+    ((list, tuple), 5),
+    (ObjectId, 7),
+    (datetime.datetime, 9),
+]
+
+
+def _type_order(value):
+    if value is MISSING:
+        return 1
+    for types, order in _TYPE_ORDER:
+        if isinstance(value, types):
+            return order
+    return 10
+
+
+def _satisfies(value, condition):
+    if not isinstance(condition, dict):
+        if condition is None:
+            return value is MISSING or value is None
+        return value is not MISSING and value == condition \
+            and _type_order(value) == _type_order(condition)
+
+    for operator, operand in condition.items():
+        if operator == "$ne":
+            if operand is None:
+                if value is MISSING or value is None:
+                    return False
+            elif value == operand:
+                return False
+        elif value is MISSING or _type_order(value) != _type_order(operand):
+            # range operators only compare values of the same type
+            return False
+        elif operator == "$gte" and not value >= operand:
+            return False
+        elif operator == "$gt" and not value > operand:
+            return False
+        elif operator == "$lt" and not value < operand:
+            return False
+    return True
+
+
+def _projected(projection):
+    if not projection:
+        return None
+    return set(field for field, include in projection.items() if include)
+
+
+def _to_storage(value):
+    """Store values as MongoDB returns them, datetimes as naive UTC"""
+    if isinstance(value, datetime.datetime) and value.tzinfo:
+        return value.astimezone(pytz.UTC).replace(tzinfo=None)
+    if isinstance(value, dict):
+        return dict((key, _to_storage(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_to_storage(item) for item in value]
+    return value
@@ -1,32 +1,406 @@
+import datetime
+import itertools
+import json
 import logging
-from bson import Code
+import os
+import threading
+import time
+from bson import Code, SON
 import pymongo
-from pymongo.errors import AutoReconnect
+from pymongo.errors import AutoReconnect, OperationFailure, PyMongoError
+
+from . import aggregations
+from .. import metrics, timeutils
+from ..record import aggregate
+from ..timeseries import PERIODS
+
+
+PERIOD_KEYS = dict((name, period.key) for name, period in PERIODS.items())
+
+# The start of the week and month are stored with each record, the start
+# of other periods is computed from _timestamp when a query groups by it
+STORED_PERIODS = ("week", "month")
+COMPUTED_PERIOD_KEYS = dict((period.key, period)
+                            for name, period in PERIODS.items()
+                            if name not in STORED_PERIODS)
 
 
 class Database(object):
+    # Seconds a write waits for a partial of its bucket to be rebuilt, and
+    # a rebuild waits for the writes in progress to finish
+    _rebuild_timeout = 60
+    _write_timeout = 30
+    _poll_interval = 0.1
+
     @classmethod
     def from_config(cls, config):
         return cls(
             config['MONGO_HOST'],
             config['MONGO_PORT'],
             config['DATABASE_NAME'],
+            config['MONGO_STORE_CHUNK_SIZE'],
+            config['MONGO_GROUP_ENGINE'],
+            config['MONGO_INDEXES'],
+            config['BUCKET_INDEXES'],
+            config['TRACK_INDEX_MISSES'],
+            ConnectionManager(
+                config['MONGO_HOST'],
+                config['MONGO_PORT'],
+                pool_size=config['MONGO_POOL_SIZE'],
+                connect_timeout_ms=config['MONGO_CONNECT_TIMEOUT_MS'],
+                socket_timeout_ms=config['MONGO_SOCKET_TIMEOUT_MS'],
+                wait_queue_timeout_ms=config['MONGO_WAIT_QUEUE_TIMEOUT_MS'],
+                replica_set=config['MONGO_REPLICA_SET'],
+                read_preference=config['MONGO_READ_PREFERENCE'],
+                write_concern=config['MONGO_WRITE_CONCERN'],
+            ),
         )
 
-    def __init__(self, host, port, name):
-        self._mongo = pymongo.Connection(host, port)
-        self._db = self._mongo[name]
+    def __init__(self, host, port, name,
+                 store_chunk_size=1000, group_engine='group',
+                 indexes=None, bucket_indexes=None, track_index_misses=False,
+                 connection=None):
+        self._connection = connection or ConnectionManager(host, port)
         self.name = name
+        self._store_chunk_size = store_chunk_size
+        self._group_engine = group_engine
+        self._indexes = IndexManager(lambda: self._db, indexes or [],
+                                     bucket_indexes or {},
+                                     track_index_misses)
+
+    @property
+    def _db(self):
+        return self._connection.client[self.name]
+
+    def connection_stats(self):
+        stats = self._connection.stats()
+        if self._connection.connected:
+            try:
+                stats['server_connections'] = \
+                    self._db.command('serverStatus')['connections']
+            except OperationFailure:
+                # Needs the clusterMonitor role
+                stats['server_connections'] = None
+        return stats
+
+    def _driver(self, bucket_name):
+        return MongoDriver(self._db[bucket_name], self._group_engine)
 
     def _collection(self, bucket_name):
-        return Collection(MongoDriver(self._db[bucket_name]))
+        return Collection(self._driver(bucket_name))
 
     def store(self, bucket_name, records):
-        for record in records:
-            self._collection(bucket_name).save(record.to_dict())
+        return self.store_batches(bucket_name, [records])[0]
+
+    def store_batches(self, bucket_name, batches):
+        """Store several batches of records in the same bulk writes
+
+        Records with a _hash that matches the stored record with the same
+        _id are not written. Returns the number of records inserted,
+        updated and unchanged for each batch.
+
+        Writes are counted as they start and finish, and wait while a
+        partial of the bucket is rebuilt, see define_partial.
+        """
+        self._indexes.ensure(bucket_name)
+        definitions = self._start_write(bucket_name)
+        try:
+            return self._store_batches(bucket_name, batches, definitions)
+        finally:
+            self._writes.update({'_id': bucket_name},
+                                {'$inc': {'finished': 1}})
+
+    def _store_batches(self, bucket_name, batches, definitions):
+        collection = self._collection(bucket_name)
+        partials = [self._partial_store(bucket_name, definition['name'],
+                                        definition['period'],
+                                        definition['group_by'])
+                    for definition in definitions]
+        partial_fields = set(['_timestamp'])
+        for partial in partials:
+            partial_fields.update(partial.keys)
+        counts = [{'inserted': 0, 'updated': 0, 'unchanged': 0}
+                  for _ in batches]
+        records = ((index, record) for index, batch in enumerate(batches)
+                   for record in batch)
+        for chunk in _chunks(records, self._store_chunk_size):
+            changed, docs = [], []
+            for index, doc in skip_unchanged(
+                    collection, [(index, record.to_dict())
+                                 for index, record in chunk]):
+                if doc is None:
+                    counts[index]['unchanged'] += 1
+                else:
+                    changed.append(index)
+                    docs.append(doc)
+            if not docs:
+                continue
+
+            if partials:
+                replaced_docs = _replaced_docs(collection, docs,
+                                               list(partial_fields))
+            try:
+                replaced = collection.save_all(docs)
+                for partial in partials:
+                    partial.add(docs)
+                    partial.remove(replaced_docs)
+            except PyMongoError:
+                # Some of the docs may be saved without being counted
+                if partials:
+                    self._mark_partials_stale(bucket_name)
+                raise
+            for index, was_replaced in zip(changed, replaced):
+                counts[index]['updated' if was_replaced else 'inserted'] += 1
+
+        return counts
+
+    def _start_write(self, bucket_name):
+        """Count a write as started once no partial is being rebuilt
+
+        Returns the definitions of the partials of the bucket. A rebuild
+        started more than _rebuild_timeout ago is taken to have failed,
+        and its partial is marked stale.
+        """
+        while True:
+            self._writes.update({'_id': bucket_name},
+                                {'$inc': {'started': 1, 'finished': 0}},
+                                upsert=True)
+            definitions = list(self._partial_definitions.find(
+                {'bucket': bucket_name},
+                read_preference=pymongo.ReadPreference.PRIMARY))
+            rebuilding_at = [timeutils.utc(definition['rebuilding_at'])
+                             for definition in definitions
+                             if definition.get('rebuilding_at')]
+            if not rebuilding_at:
+                return definitions
+
+            self._writes.update({'_id': bucket_name},
+                                {'$inc': {'finished': 1}})
+            timed_out = timeutils.now() - datetime.timedelta(
+                seconds=self._rebuild_timeout)
+            if min(rebuilding_at) < timed_out:
+                logging.warning("Gave up waiting for a partial of %s to be "
+                                "rebuilt", bucket_name)
+                self._partial_definitions.update(
+                    {'bucket': bucket_name,
+                     'rebuilding_at': {'$lt': timed_out}},
+                    {'$set': {'rebuilding_at': None, 'stale': True}},
+                    multi=True)
+            else:
+                time.sleep(self._poll_interval)
+
+    def _wait_for_writes(self, bucket_name):
+        """Wait for the writes to a bucket in progress to finish
+
+        Writes that have not finished after _write_timeout are taken to
+        have been lost with their process.
+        """
+        deadline = time.time() + self._write_timeout
+        while True:
+            writes = self._writes.find_one(
+                bucket_name,
+                read_preference=pymongo.ReadPreference.PRIMARY) or {}
+            unfinished = writes.get('started', 0) - writes.get('finished', 0)
+            if unfinished <= 0:
+                return
+            if time.time() > deadline:
+                logging.warning("Taking %d unfinished writes to %s as lost",
+                                unfinished, bucket_name)
+                self._writes.update({'_id': bucket_name},
+                                    {'$inc': {'finished': unfinished}})
+                return
+            time.sleep(self._poll_interval)
+
+    def _mark_partials_stale(self, bucket_name):
+        try:
+            self._partial_definitions.update(
+                {'bucket': bucket_name}, {'$set': {'stale': True}},
+                multi=True)
+        except PyMongoError:
+            logging.exception("Could not mark the partials of %s stale",
+                              bucket_name)
+
+    @property
+    def _writes(self):
+        return self._db['_writes']
 
     def query(self, bucket_name, query):
-        return Query(query).execute(self._collection(bucket_name))
+        query = Query(query)
+        self._indexes.check(bucket_name, query.index_fields())
+        return query.execute(self._collection(bucket_name))
+
+    def index_report(self, bucket_name):
+        return self._indexes.report(bucket_name)
+
+    def bump_version(self, bucket_name, updated_at):
+        self._db['_generations'].update(
+            {'_id': bucket_name},
+            {'$inc': {'generation': 1}, '$set': {'updated_at': updated_at}},
+            upsert=True)
+
+    def version(self, bucket_name):
+        # Versions key cached responses and validators, so they are read
+        # from the primary even when queries go to secondaries
+        doc = self._db['_generations'].find_one(
+            bucket_name, read_preference=pymongo.ReadPreference.PRIMARY) or {}
+        return doc.get('generation', 0), doc.get('updated_at')
+
+    def _partial_store(self, bucket_name, partial_name, period, group_by):
+        return PartialStore(
+            self._db['{0}.partials.{1}'.format(bucket_name, partial_name)],
+            period, group_by)
+
+    @property
+    def _partial_definitions(self):
+        return self._db['_partial_queries']
+
+    def partial_definition(self, bucket_name, partial_name):
+        definition = self._partial_definitions.find_one(
+            _partial_id(bucket_name, partial_name))
+        if definition:
+            return {'period': definition['period'],
+                    'group_by': definition['group_by']}
+
+    def define_partial(self, bucket_name, partial_name, query):
+        """Define a partial and build its counts from the raw records
+
+        Counts added to a partial while it is rebuilt would be lost, so
+        the definition holds off writes to the bucket until the writes in
+        progress have finished and the rebuild is done. Queries group the
+        raw records while a partial is rebuilt or stale.
+        """
+        _id = _partial_id(bucket_name, partial_name)
+        rebuilding_at = timeutils.now()
+        self._partial_definitions.update({'_id': _id}, {'$set': {
+            'bucket': bucket_name,
+            'name': partial_name,
+            'period': query.period,
+            'group_by': query.group_by,
+            'rebuilding_at': rebuilding_at,
+            'stale': True,
+        }}, upsert=True)
+
+        rebuilt = False
+        try:
+            self._wait_for_writes(bucket_name)
+            self._partial_store(
+                bucket_name, partial_name, query.period, query.group_by
+            ).rebuild(self._driver(bucket_name))
+            rebuilt = True
+        finally:
+            # Writes that gave up waiting have marked the partial stale
+            self._partial_definitions.update(
+                {'_id': _id, 'rebuilding_at': rebuilding_at},
+                {'$set': {'rebuilding_at': None, 'stale': not rebuilt}})
+
+    def delete_partial(self, bucket_name, partial_name):
+        definition = self.partial_definition(bucket_name, partial_name)
+        if definition:
+            self._partial_definitions.remove(
+                _partial_id(bucket_name, partial_name))
+            self._partial_store(
+                bucket_name, partial_name,
+                definition['period'], definition['group_by']).drop()
+        return definition is not None
+
+    def query_partial(self, bucket_name, partial_name, query):
+        definition = self._partial_definitions.find_one(
+            _partial_id(bucket_name, partial_name),
+            read_preference=pymongo.ReadPreference.PRIMARY) or {}
+        if definition.get('stale') or definition.get('rebuilding_at'):
+            return group_partial(self._driver(bucket_name), query)
+        return self._partial_store(
+            bucket_name, partial_name, query.period, query.group_by
+        ).find(query.start_at, query.end_at)
+
+
+class ConnectionManager(object):
+    """Connect to MongoDB lazily, once in each process
+
+    Under a preforking server the apps are imported before the workers
+    fork, so a connection made then would share its sockets between all
+    of them. The client is created on first use instead, and created
+    again when first used in a new process.
+
+    Reads go to the read preference, eg. 'secondary_preferred', which
+    needs a replica_set to reach secondaries. Writes wait for the write
+    concern, eg. {'w': 'majority', 'wtimeout': 5000}; it must
+    acknowledge writes as stores report counts from the acknowledgement.
+    """
+    def __init__(self, host, port, pool_size=100, connect_timeout_ms=20000,
+                 socket_timeout_ms=None, wait_queue_timeout_ms=None,
+                 replica_set=None, read_preference='primary',
+                 write_concern=None):
+        self._host = host
+        self._port = port
+        self._pool_size = pool_size
+        self._timeouts = {
+            'connectTimeoutMS': connect_timeout_ms,
+            'socketTimeoutMS': socket_timeout_ms,
+            'waitQueueTimeoutMS': wait_queue_timeout_ms,
+        }
+        self._replica_set = replica_set
+        self._read_preference = read_preference
+        self._write_concern = write_concern or {}
+        if not hasattr(pymongo.ReadPreference, read_preference.upper()):
+            raise ValueError(
+                'Unknown read preference "{0}"'.format(read_preference))
+        if self._write_concern.get('w') == 0:
+            raise ValueError('The write concern must acknowledge writes')
+
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+
+    @property
+    def connected(self):
+        return self._client is not None and self._pid == os.getpid()
+
+    @property
+    def client(self):
+        if not self.connected:
+            with self._lock:
+                if not self.connected:
+                    self._client = self._connect()
+                    self._pid = os.getpid()
+        return self._client
+
+    def _connect(self):
+        options = dict(
+            (name, value) for name, value in self._timeouts.items()
+            if value is not None)
+        options.update(self._write_concern)
+        options['max_pool_size'] = self._pool_size
+        options['read_preference'] = getattr(
+            pymongo.ReadPreference, self._read_preference.upper())
+
+        if self._replica_set:
+            return pymongo.MongoReplicaSetClient(
+                self._host, port=self._port, replicaSet=self._replica_set,
+                **options)
+        return pymongo.MongoClient(self._host, self._port, **options)
+
+    def stats(self):
+        """Whether this process is connected, and how it connects
+
+        The client does not expose the use of its pools, so the only live
+        numbers are the server's connection counts, see
+        Database.connection_stats.
+        """
+        return {
+            'pid': os.getpid(),
+            'connected': self.connected,
+            'config': {
+                'pool_size': self._pool_size,
+                'connect_timeout_ms': self._timeouts['connectTimeoutMS'],
+                'socket_timeout_ms': self._timeouts['socketTimeoutMS'],
+                'wait_queue_timeout_ms':
+                    self._timeouts['waitQueueTimeoutMS'],
+                'replica_set': self._replica_set,
+                'read_preference': self._read_preference,
+                'write_concern': self._write_concern,
+            },
+        }
 
 
 class Query(object):
@@ -43,31 +417,48 @@ class Query(object):
                 mongo_query["_timestamp"]["$gte"] = self.query.start_at
         if self.query.filter_by:
             # TODO: fix this!
-            for filters in self.query.filter_by:
-                if filters[1] == "true":
-                    filters[1] = True
-                if filters[1] == "false":
-                    filters[1] = False
-                mongo_query.update({filters[0]: filters[1]})
+            for field, value in self.query.filter_by:
+                if value == "true":
+                    value = True
+                if value == "false":
+                    value = False
+                mongo_query[field] = value
+        if self.query.after:
+            mongo_query["$or"] = self.__records_after(*self.query.after)
         return mongo_query
 
+    def __records_after(self, timestamp, _id):
+        # records without a timestamp sort before all others
+        if timestamp is None:
+            later = {"_timestamp": {"$ne": None}}
+        else:
+            later = {"_timestamp": {"$gt": timestamp}}
+        return [later, {"_timestamp": timestamp, "_id": {"$gt": _id}}]
+
+    def index_fields(self):
+        """The fields the database could use an index on for this query"""
+        fields = set(self.to_mongo_query())
+        if self.query.group_by:
+            fields.add(self.query.group_by)
+        if self.query.period:
+            fields.add(grouping_field(self.__get_period_key()))
+        if self.query.is_raw_query:
+            fields.add((self.query.sort_by or ["_timestamp"])[0])
+        return sorted(fields)
+
     def execute(self, collection):
         if self.query.is_period_grouped_query:
             result = self.__execute_period_group_query(collection)
         elif self.query.is_grouped_query:
             result = self.__execute_grouped_query(collection)
-        elif self.query.is_period:
+        elif self.query.is_period_query:
             result = self.__execute_period_query(collection)
         else:
             result = self.__execute_query(collection)
         return result
 
     def __get_period_key(self):
-        period_keys = {
-            "week": "_week_start_at",
-            "month": "_month_start_at"
-        }
-        return period_keys[self.query.period]
+        return PERIOD_KEYS[self.query.period]
 
     def __execute_period_group_query(self, collection):
         period_key = self.__get_period_key()
@@ -88,17 +479,36 @@ class Query(object):
         sort = [period_key, "ascending"]
         return collection.group(
             period_key, self,
-            sort=sort, limit=self.query.limit
+            sort=sort, limit=self.query.limit,
+            collect=self.query.collect
         )
 
     def __execute_query(self, collection):
         return collection.find(
-            self, sort=self.query.sort_by, limit=self.query.limit)
+            self, sort=self.query.sort_by, limit=self.query.limit,
+            fields=self.__projection())
+
+    def __projection(self):
+        if not self.query.fields:
+            return None
+        fields = set(self.query.fields)
+        if self.query.page_size:
+            # the next page starts from the last record's position
+            fields.update(["_timestamp", "_id"])
+        projection = dict((field, 1) for field in fields)
+        if "_id" not in fields:
+            projection["_id"] = 0
+        return projection
 
 
 class MongoDriver(object):
-    def __init__(self, collection):
+    def __init__(self, collection, group_engine='group'):
+        if group_engine not in GROUP_ENGINES:
+            raise ValueError(
+                'Unknown group engine "{0}"'.format(group_engine))
+
         self._collection = collection
+        self._group_engine = group_engine
         self.sort_options = {
             "ascending": pymongo.ASCENDING,
             "descending": pymongo.DESCENDING
@@ -108,10 +518,12 @@ class MongoDriver(object):
         if direction not in self.sort_options.keys():
             raise InvalidSortError(direction)
 
-        cursor.sort(key, self.sort_options[direction])
+        # _id breaks ties so that pages of records can be resumed
+        cursor.sort([(key, self.sort_options[direction]),
+                     ("_id", self.sort_options[direction])])
 
-    def find(self, query, sort, limit):
-        cursor = self._collection.find(query)
+    def find(self, query, sort, limit, fields=None):
+        cursor = self._collection.find(query, fields)
         self._apply_sorting(cursor, sort[0], sort[1])
         if limit:
             cursor.limit(limit)
@@ -119,28 +531,153 @@ class MongoDriver(object):
 
     def _ignore_docs_without_grouping_keys(self, keys, query):
         for key in keys:
-            if key not in query:
-                query[key] = {"$ne": None}
+            field = grouping_field(key)
+            if field not in query:
+                query[field] = {"$ne": None}
         return query
 
-    def group(self, keys, query, collect):
-        return self._collection.group(
-            key=keys,
-            condition=self._ignore_docs_without_grouping_keys(keys, query),
-            initial=self._build_accumulator_initial_state(collect),
-            reduce=self._build_reducer_function(collect)
-        )
+    def group(self, keys, query, collect, sort=None, limit=None):
+        """Return one row per distinct combination of keys
+
+        Each row has the key values, a _count and the state of each
+        collected aggregation. The states of single key groupings are
+        never merged, so they are finalized in the database where an
+        aggregation can be, eg. to count distinct values rather than
+        return them all. The aggregate engine sorts and limits single key
+        groupings in the database when it can, callers must still apply
+        sort and limit themselves.
+        """
+        query = self._ignore_docs_without_grouping_keys(keys, query)
+
+        with metrics.timer('database.group'):
+            if self._group_engine == 'aggregate':
+                return self._aggregate(keys, query, collect, sort, limit)
+
+            return self._collection.group(
+                key=self._build_key_function(keys),
+                condition=query,
+                initial=self._build_accumulator_initial_state(collect),
+                reduce=self._build_reducer_function(collect),
+                finalize=self._build_finalize_function(keys, collect)
+            )
+
+    def _aggregate(self, keys, query, collect, sort, limit):
+        project_stage = self._build_project_stage(keys, collect)
+        group_stage = self._build_group_stage(keys, collect)
+        pipeline = [
+            {"$match": query},
+            {"$project": project_stage},
+            {"$group": group_stage},
+        ]
+        if len(keys) == 1:
+            pipeline += self._build_final_stages(group_stage, collect)
+            pipeline += self._build_sort_and_limit_stages(
+                keys[0], sort, limit)
+
+        # Read the results from a cursor, as a single reply document is
+        # limited to 16MB
+        cursor = self._collection.aggregate(pipeline, cursor={})
+        rows = [self._flatten_group_id(doc) for doc in cursor]
+
+        for aggregation in aggregations.parse(collect):
+            if isinstance(aggregation, aggregations.Percentile):
+                self._add_sketches(rows, keys, query, project_stage,
+                                   aggregation)
+
+        return [self._decode_period_starts(row, keys) for row in rows]
+
+    def _add_sketches(self, rows, keys, query, project_stage, percentile):
+        """Add the sketch of a percentile to each row from its buckets"""
+        pipeline = [
+            {"$match": query},
+            {"$project": project_stage},
+        ] + percentile.bucket_stages(dict((key, "$" + key) for key in keys))
+
+        sketches = {}
+        for doc in self._collection.aggregate(pipeline, cursor={}):
+            bucket = doc["_id"]
+            group = index_key([bucket.get(key) for key in keys])
+            sketches.setdefault(group, aggregations.Sketch()).add_bucket(
+                bucket["_sign"], int(bucket["_index"]), doc["_count"])
+
+        for row in rows:
+            sketch = sketches.get(index_key([row[key] for key in keys]),
+                                  aggregations.Sketch())
+            row[percentile.key] = sketch.to_document()
+
+    def _build_project_stage(self, keys, collect):
+        stage = dict((field, 1)
+                     for field in keys + aggregations.fields(collect))
+        for key in keys:
+            if key in COMPUTED_PERIOD_KEYS:
+                stage[key] = _period_start_number(
+                    COMPUTED_PERIOD_KEYS[key].name)
+        return stage
+
+    def _decode_period_starts(self, row, keys):
+        for key in keys:
+            if key in COMPUTED_PERIOD_KEYS:
+                row[key] = _decode_period_start(row[key])
+        return row
+
+    def _build_group_stage(self, keys, collect):
+        stage = {
+            "_id": dict((key, "$" + key) for key in keys),
+            "_count": {"$sum": 1},
+        }
+        for aggregation in aggregations.parse(collect):
+            stage.update(aggregation.accumulators())
+        return stage
+
+    def _build_final_stages(self, group_stage, collect):
+        final = dict((aggregation.key, aggregation.final_expression())
+                     for aggregation in aggregations.parse(collect)
+                     if aggregation.final_expression())
+        if not final:
+            return []
+        stage = dict((field, 1) for field in group_stage)
+        stage.update(final)
+        return [{"$project": stage}]
+
+    def _build_sort_and_limit_stages(self, key, sort, limit):
+        if not sort or sort[0] not in (key, "_count"):
+            return []
+
+        sort_key = "_id." + key if sort[0] == key else "_count"
+        stages = [{"$sort": SON([(sort_key, self.sort_options[sort[1]])])}]
+        if limit:
+            stages.append({"$limit": limit})
+        return stages
+
+    def _flatten_group_id(self, doc):
+        row = doc.pop("_id")
+        row.update(doc)
+        return row
+
+    def _build_key_function(self, keys):
+        """Group by a list of fields or, for computed periods, a function"""
+        if not any(key in COMPUTED_PERIOD_KEYS for key in keys):
+            return keys
+
+        values = []
+        for key in keys:
+            if key in COMPUTED_PERIOD_KEYS:
+                value = _PERIOD_START_JS[COMPUTED_PERIOD_KEYS[key].name]
+            else:
+                value = "doc[{0}]".format(json.dumps(key))
+            values.append("{0}: {1}".format(json.dumps(key), value))
+
+        return Code("function (doc) {{ var t = doc._timestamp; "
+                    "return {{{0}}}; }}".format(", ".join(values)))
 
     def _build_collector_code(self, collect):
-        template = "if (current.{c} !== undefined) " \
-                   "{{ previous.{c}.push(current.{c}); }}"
-        code = [template.format(c=collect_me) for collect_me in collect]
-        return "\n".join(code)
+        return "\n".join(aggregation.reducer()
+                         for aggregation in aggregations.parse(collect))
 
     def _build_accumulator_initial_state(self, collect):
         initial = {'_count': 0}
-        for collect_me in collect:
-            initial.update({collect_me: []})
+        for aggregation in aggregations.parse(collect):
+            initial.update(aggregation.initial())
         return initial
 
     def _build_reducer_function(self, collect):
@@ -152,17 +689,66 @@ class MongoDriver(object):
         reducer = Code(reducer_code)
         return reducer
 
+    def _build_finalize_function(self, keys, collect):
+        if len(keys) != 1:
+            return None
+        finalizers = [aggregation.finalizer()
+                      for aggregation in aggregations.parse(collect)
+                      if aggregation.finalizer()]
+        if not finalizers:
+            return None
+        return Code("function (out) {{ {0} }}".format(" ".join(finalizers)))
+
+    def _retry_on_reconnect(self, operation, tries):
+        for remaining in range(tries, 0, -1):
+            try:
+                return operation()
+            except AutoReconnect:
+                logging.warning("AutoReconnect on save")
+                metrics.incr("database.auto_reconnect")
+                if remaining == 1:
+                    raise
+
     def save(self, obj, tries=3):
-        try:
-            self._collection.save(obj)
-        except AutoReconnect:
-            logging.warning("AutoReconnect on save")
-            # TOOD: pull this over
-            # statsd.incr("db.AutoReconnect", bucket=self._collection.name)
-            if tries > 1:
-                self.save(obj, tries - 1)
+        self._retry_on_reconnect(lambda: self._collection.save(obj), tries)
+
+    def save_all(self, docs, tries=3):
+        """Save documents with a single unordered bulk write
+
+        Documents with an _id replace any existing document with that _id,
+        all others are inserted. Returns whether each document replaced an
+        existing one.
+        """
+        def save():
+            has_id = ['_id' in doc for doc in docs]
+            result = self._build_bulk_save(docs).execute()
+            upserted = set(upsert['index'] for upsert in result['upserted'])
+            return [replaces and index not in upserted
+                    for index, replaces in enumerate(has_id)]
+
+        return self._retry_on_reconnect(save, tries)
+
+    def hashes(self, ids):
+        """The _hash of each stored document with one of the ids"""
+        return dict((doc['_id'], doc.get('_hash')) for doc in
+                    self._collection.find({'_id': {'$in': ids}},
+                                          {'_hash': 1}))
+
+    def find_by_ids(self, ids, fields):
+        """The fields of each stored document with one of the ids"""
+        return dict((doc['_id'], doc) for doc in
+                    self._collection.find({'_id': {'$in': ids}}, fields))
+
+    def _build_bulk_save(self, docs):
+        # Inserts assign an _id to the document, so a retried chunk
+        # upserts the documents that made it in before the failure.
+        bulk = self._collection.initialize_unordered_bulk_op()
+        for doc in docs:
+            if '_id' in doc:
+                bulk.find({'_id': doc['_id']}).upsert().replace_one(doc)
             else:
-                raise
+                bulk.insert(doc)
+        return bulk
 
 
 class Collection(object):
@@ -172,6 +758,15 @@ class Collection(object):
     def save(self, obj, tries=3):
         self._collection.save(obj)
 
+    def save_all(self, docs):
+        return self._collection.save_all(docs)
+
+    def hashes(self, ids):
+        return self._collection.hashes(ids)
+
+    def find_by_ids(self, ids, fields):
+        return self._collection.find_by_ids(ids, fields)
+
     def _validate_sort(self, sort):
         if len(sort) != 2:
             raise InvalidSortError("Expected a key and direction")
@@ -179,13 +774,14 @@ class Collection(object):
         if sort[1] not in ["ascending", "descending"]:
             raise InvalidSortError(sort[1])
 
-    def find(self, query, sort=None, limit=None):
+    def find(self, query, sort=None, limit=None, fields=None):
         if not sort:
             sort = ["_timestamp", "ascending"]
 
         self._validate_sort(sort)
 
-        return self._collection.find(query.to_mongo_query(), sort, limit)
+        return self._collection.find(
+            query.to_mongo_query(), sort, limit, fields)
 
     def multi_group(self, key1, key2, query,
                     sort=None, limit=None, collect=None):
@@ -217,7 +813,7 @@ class Collection(object):
             collect or [])
 
     def _group(self, keys, query, sort=None, limit=None, collect=None):
-        results = self._collection.group(keys, query, collect)
+        results = self._collection.group(keys, query, collect, sort, limit)
 
         results = nested_merge(keys, collect, results)
 
@@ -237,80 +833,379 @@ class Collection(object):
         return results
 
 
-class GroupingError(ValueError):
-    pass
+class IndexManager(object):
+    """Create the indexes for buckets and note queries no index serves
+
+    An index can serve a query when its first field is one the query
+    matches, groups or sorts on.
+    """
+    _index_info_ttl = 300
+
+    def __init__(self, database, indexes, bucket_indexes, track_misses):
+        self._database = database
+        self._indexes = indexes
+        self._bucket_indexes = bucket_indexes
+        self._track_misses = track_misses
+        self._ensured = set()
+        self._leading_fields = {}
+
+    def ensure(self, bucket_name):
+        if bucket_name in self._ensured:
+            return
+        for fields in self._indexes + \
+                self._bucket_indexes.get(bucket_name, []):
+            self._db[bucket_name].ensure_index(
+                [(field, pymongo.ASCENDING) for field in fields],
+                background=True)
+        self._ensured.add(bucket_name)
+
+    def check(self, bucket_name, fields):
+        if not self._track_misses:
+            return
+        if self._leading_fields_of(bucket_name).intersection(fields):
+            return
+        self._misses.update(
+            {"_id": "{0}:{1}".format(bucket_name, ",".join(fields))},
+            {"$set": {"bucket": bucket_name,
+                      "fields": fields,
+                      "last_seen_at": timeutils.now()},
+             "$inc": {"count": 1}},
+            upsert=True, w=0)
+
+    def report(self, bucket_name):
+        indexes = self._db[bucket_name].index_information()
+        return {
+            "indexes": [{"name": name, "key": info["key"]}
+                        for name, info in sorted(indexes.items())],
+            "missed_queries": [
+                {"fields": miss["fields"],
+                 "suggested_index": _suggested_index(miss["fields"]),
+                 "count": miss["count"],
+                 "last_seen_at": miss["last_seen_at"]}
+                for miss in self._misses.find({"bucket": bucket_name})
+                                        .sort("count", pymongo.DESCENDING)],
+        }
 
+    @property
+    def _db(self):
+        return self._database()
 
-class InvalidSortError(ValueError):
-    pass
+    @property
+    def _misses(self):
+        return self._db["_index_misses"]
 
+    def _leading_fields_of(self, bucket_name):
+        expires_at, fields = self._leading_fields.get(bucket_name, (0, None))
+        if expires_at < time.time():
+            fields = set(info["key"][0][0] for info in
+                         self._db[bucket_name].index_information().values())
+            self._leading_fields[bucket_name] = \
+                (time.time() + self._index_info_ttl, fields)
+        return fields
 
-def extract_collected_values(collect, result):
-    collected = {}
-    for collect_field in collect:
-        collected[collect_field] = result.pop(collect_field)
-    return collected, result
 
+class PartialStore(object):
+    """Record counts materialized for a partial query
 
-def insert_collected_values(collected, group):
-    for collect_field in collected.keys():
-        if collect_field not in group:
-            group[collect_field] = set()
-        group[collect_field].update(collected[collect_field])
+    Each document holds the values of the grouping keys as its _id and a
+    _count, so reading it back gives the same rows as a group query over
+    the raw records.
+    """
+    def __init__(self, collection, period, group_by):
+        self._collection = collection
+        self._period_key = PERIOD_KEYS[period] if period else None
+        self.keys = [key for key in [group_by, self._period_key] if key]
+
+    def add(self, docs):
+        self._inc(docs, 1)
+
+    def remove(self, docs):
+        """Take documents that have been replaced out of the counts"""
+        if self._inc(docs, -1):
+            self._collection.remove({"_count": {"$lte": 0}})
+
+    def _inc(self, docs, sign):
+        if self._period_key in COMPUTED_PERIOD_KEYS:
+            docs = [with_period_start(self._period_key, doc) for doc in docs]
+        aggregates = aggregate(self.keys, docs)
+        if not aggregates:
+            return False
+
+        bulk = self._collection.initialize_unordered_bulk_op()
+        for aggregate_record in aggregates:
+            group = bulk.find({"_id": SON(aggregate_record.group)})
+            if sign > 0:
+                group = group.upsert()
+            group.update({"$inc": {"_count": sign * aggregate_record.count}})
+        bulk.execute()
+        return True
+
+    def rebuild(self, driver):
+        """Replace the counts with a fresh grouping of the raw records"""
+        rows = driver.group(self.keys, {}, [])
+        if not rows:
+            self.drop()
+            return
+
+        staging = self._collection.database[
+            self._collection.name + '.rebuild']
+        staging.drop()
+        staging.insert([self._to_document(row) for row in rows])
+        staging.rename(self._collection.name, dropTarget=True)
+
+    def drop(self):
+        self._collection.drop()
+
+    def find(self, start_at=None, end_at=None):
+        spec = {}
+        if self._period_key and (start_at or end_at):
+            spec["_id." + self._period_key] = {}
+            if end_at:
+                spec["_id." + self._period_key]["$lt"] = end_at
+            if start_at:
+                spec["_id." + self._period_key]["$gte"] = start_at
+
+        results = nested_merge(
+            self.keys, [], (self._to_row(doc)
+                            for doc in self._collection.find(spec)))
+
+        if self.keys == [self._period_key]:
+            results.sort(key=lambda result: result[self._period_key])
+        return results
+
+    def _to_document(self, row):
+        return {
+            "_id": SON((key, row[key]) for key in self.keys),
+            "_count": int(row["_count"]),
+        }
 
+    def _to_row(self, document):
+        row = dict(document["_id"])
+        row["_count"] = document["_count"]
+        return row
 
-def convert_collected_values_to_list(collect, groups):
-    for group in groups:
-        for collected_field in collect:
-            group[collected_field] = sorted(list(group[collected_field]))
 
+GROUP_ENGINES = ('group', 'aggregate')
 
+
+class GroupingError(ValueError):
+    pass
+
+
+class InvalidSortError(ValueError):
+    pass
+
+
+def grouping_field(key):
+    """The field a document must have to be grouped by key"""
+    if key in COMPUTED_PERIOD_KEYS:
+        return "_timestamp"
+    return key
+
+
+def with_period_start(key, doc):
+    """Add the start of a computed period to a copy of a document"""
+    if doc.get("_timestamp") is None:
+        return doc
+    doc = dict(doc)
+    doc[key] = COMPUTED_PERIOD_KEYS[key].start(doc["_timestamp"])
+    return doc
+
+
+# The aggregation framework cannot build dates from parts, so computed
+# period starts are grouped as numbers of the form YYYYMMDDHH, which
+# sort in time order, and decoded into datetimes afterwards.
+def _period_start_number(period):
+    timestamp = "$_timestamp"
+    month = {"$month": timestamp}
+    terms = [{"$multiply": [{"$year": timestamp}, 1000000]}]
+    if period == "hour":
+        terms += [{"$multiply": [month, 10000]},
+                  {"$multiply": [{"$dayOfMonth": timestamp}, 100]},
+                  {"$hour": timestamp}]
+    elif period == "day":
+        terms += [{"$multiply": [month, 10000]},
+                  {"$multiply": [{"$dayOfMonth": timestamp}, 100]}]
+    elif period == "quarter":
+        first_month = {"$subtract": [
+            month, {"$mod": [{"$subtract": [month, 1]}, 3]}]}
+        terms += [{"$multiply": [first_month, 10000]}, 100]
+    elif period == "year":
+        terms += [10100]
+    return {"$add": terms}
+
+
+def _decode_period_start(number):
+    number = int(number)
+    return datetime.datetime(number // 1000000, number // 10000 % 100,
+                             number // 100 % 100, number % 100)
+
+
+_PERIOD_START_JS = {
+    "hour": "new Date(Date.UTC(t.getUTCFullYear(), t.getUTCMonth(), "
+            "t.getUTCDate(), t.getUTCHours()))",
+    "day": "new Date(Date.UTC(t.getUTCFullYear(), t.getUTCMonth(), "
+           "t.getUTCDate()))",
+    "quarter": "new Date(Date.UTC(t.getUTCFullYear(), "
+               "t.getUTCMonth() - t.getUTCMonth() % 3, 1))",
+    "year": "new Date(Date.UTC(t.getUTCFullYear(), 0, 1))",
+}
+
+
+def group_partial(driver, query):
+    """Group the raw records into the rows a partial query store holds"""
+    period = PERIODS[query.period] if query.period else None
+    keys = [key for key in [query.group_by, period and period.key] if key]
+
+    spec = {}
+    if period and (query.start_at or query.end_at):
+        # Partials select whole periods that start within the range
+        spec["_timestamp"] = {}
+        if query.end_at:
+            spec["_timestamp"]["$lt"] = period.end(query.end_at)
+        if query.start_at:
+            spec["_timestamp"]["$gte"] = period.end(query.start_at)
+
+    results = nested_merge(keys, [], driver.group(keys, spec, []))
+    if period and keys == [period.key]:
+        results.sort(key=lambda result: result[period.key])
+    return results
+
+
+def _partial_id(bucket_name, partial_name):
+    return '{0}.{1}'.format(bucket_name, partial_name)
+
+
+def skip_unchanged(collection, docs):
+    """Pair each (index, doc) with None where the doc is unchanged
+
+    Only docs with a _hash and an _id are looked up, with one query.
+    """
+    ids = [doc['_id'] for _, doc in docs if '_hash' in doc and '_id' in doc]
+    if not ids:
+        return docs
+    stored = collection.hashes(ids)
+    return [(index, None if '_hash' in doc and
+             stored.get(doc.get('_id')) == doc['_hash'] else doc)
+            for index, doc in docs]
+
+
+def _replaced_docs(collection, docs, fields):
+    """The documents that saving docs replaces, with only fields
+
+    A document replaced earlier in the same docs is replaced again by
+    the later one.
+    """
+    ids = [doc['_id'] for doc in docs if '_id' in doc]
+    if not ids:
+        return []
+    previous = collection.find_by_ids(ids, fields)
+    replaced = []
+    for doc in docs:
+        if '_id' in doc:
+            if doc['_id'] in previous:
+                replaced.append(previous[doc['_id']])
+            previous[doc['_id']] = doc
+    return replaced
+
+
+def _suggested_index(fields):
+    """A compound index for the fields of a query no index serves
+
+    The fields the query matches or groups on come first, then the period
+    it groups by and last the _timestamp range it selects.
+    """
+    return [field for field in sorted(
+        fields, key=lambda field: (field.startswith('_'),
+                                   field == '_timestamp'))
+        if not field.startswith('$')]
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@metrics.timed('database.nested_merge')
 def nested_merge(keys, collect, results):
+    """Merge flat group rows into groups nested in the order of keys
+
+    Collected aggregations are merged into the top level groups, and
+    subgroups also keep their own aggregates unless they are lists of
+    values.
+    """
+    collected = aggregations.parse(collect)
     groups = []
+    index = {}
     for result in results:
-        collected, result = extract_collected_values(collect, result)
+        states = [(aggregation, aggregation.pop_state(result))
+                  for aggregation in collected]
+
+        if len(keys) > 1:
+            for aggregation, state in states:
+                if aggregation.in_subgroups:
+                    result[aggregation.name] = aggregation.value(state)
 
-        groups, group = _merge(groups, keys, result)
+        group = _merge(groups, index, keys, result)
 
-        insert_collected_values(collected, group)
+        for aggregation, state in states:
+            if aggregation.name in group:
+                state = aggregation.merge(group[aggregation.name], state)
+            group[aggregation.name] = state
 
-    convert_collected_values_to_list(collect, groups)
+    _sort_and_count_subgroups(keys, groups)
+    for group in groups:
+        for aggregation in collected:
+            group[aggregation.name] = aggregation.value(
+                group[aggregation.name])
     return groups
 
 
-def _merge(groups, keys, result):
-    keys = list(keys)
-    key = keys.pop(0)
-    is_leaf = (len(keys) == 0)
+def _merge(groups, index, keys, result):
+    """Merge a result into groups and return its top level group
+
+    index maps each group value to its node and the index of the node's
+    subgroups, so finding a group is a dict lookup rather than a scan.
+    """
+    key = keys[0]
+    is_leaf = (len(keys) == 1)
     value = result.pop(key)
+    value_key = index_key(value)
 
-    group = _find_group(group for group in groups if group[key] == value)
-    if not group:
+    if value_key not in index:
         if is_leaf:
-            group = _new_leaf_node(key, value, result)
+            index[value_key] = (_new_leaf_node(key, value, result), None)
         else:
-            group = _new_branch_node(key, value)
-        groups.append(group)
+            index[value_key] = (_new_branch_node(key, value), {})
+        groups.append(index[value_key][0])
 
+    group, subgroup_index = index[value_key]
     if not is_leaf:
-        _merge_and_sort_subgroup(group, keys, result)
-        _add_branch_node_counts(group)
-    return groups, group
+        _merge(group['_subgroup'], subgroup_index, keys[1:], result)
+    return group
 
 
-def _find_group(items):
-    """Return the first item in an iterator or None"""
-    try:
-        return next(items)
-    except StopIteration:
-        return
+def index_key(value):
+    """A hashable key for a value that may be a list or document"""
+    if isinstance(value, list):
+        return tuple(index_key(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, index_key(item))
+                            for key, item in value.items()))
+    return value
 
 
 def _new_branch_node(key, value):
     """Create a new node that has further sub-groups"""
     return {
         key: value,
-        "_subgroup": []
+        "_subgroup": [],
+        "_count": 0,
+        "_group_count": 0,
     }
 
 
@@ -320,9 +1215,14 @@ def _new_leaf_node(key, value, result):
     return result
 
 
-def _merge_and_sort_subgroup(group, keys, result):
-    group['_subgroup'], _ = _merge(group['_subgroup'], keys, result)
-    group['_subgroup'].sort(key=lambda d: d[keys[0]])
+def _sort_and_count_subgroups(keys, groups):
+    """Sort and count the subgroups of branch nodes, deepest first"""
+    if len(keys) == 1:
+        return
+    for group in groups:
+        _sort_and_count_subgroups(keys[1:], group['_subgroup'])
+        group['_subgroup'].sort(key=lambda d: d[keys[1]])
+        _add_branch_node_counts(group)
 
 
 def _add_branch_node_counts(group):
@@ -1,7 +1,9 @@
+import hashlib
 from datetime import timedelta
-from functools import update_wrapper
+from functools import update_wrapper, wraps
 
 from flask import current_app, request, make_response
+import pytz
 
 
 def crossdomain(origin=None, methods=None, headers=None,
@@ -49,3 +51,51 @@ def crossdomain(origin=None, methods=None, headers=None,
         return update_wrapper(wrapped_function, f)
 
     return decorator
+
+
+def conditional(view):
+    """Answer conditional requests from the version of the bucket
+
+    The view receives the bucket version and must only return data from
+    that version of the bucket. Requests for an unchanged representation
+    get a 304 before the view runs.
+    """
+    @wraps(view)
+    def wrapper(bucket, **kwargs):
+        version = bucket.version()
+        etag = hashlib.md5(repr((bucket.name, version.generation,
+                                 request.path, request.query_string,
+                                 request.is_xhr))).hexdigest()
+
+        if _not_modified(etag, version.updated_at):
+            resp = current_app.response_class(status=304)
+        else:
+            resp = make_response(view(bucket=bucket, version=version,
+                                      **kwargs))
+            if resp.status_code != 200:
+                return resp
+
+        resp.set_etag(etag)
+        if version.updated_at:
+            resp.last_modified = version.updated_at
+        return resp
+
+    return wrapper
+
+
+def _not_modified(etag, last_modified):
+    # The ETag changes with every write, so it takes precedence
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified:
+        # HTTP dates have no fractional seconds, so a write later in the
+        # second the client has may not be in its copy
+        return _naive_utc(last_modified) < \
+            _naive_utc(request.if_modified_since)
+    return False
+
+
+def _naive_utc(time):
+    if time.tzinfo is not None:
+        time = time.astimezone(pytz.utc).replace(tzinfo=None)
+    return time
@@ -2,5 +2,42 @@ DATABASE_NAME = 'backdrop'
 
 MONGO_HOST = 'localhost'
 MONGO_PORT = 27017
+MONGO_STORE_CHUNK_SIZE = 1000
+MONGO_GROUP_ENGINE = 'group'
+
+# Connections are made lazily in each worker process, see
+# backdrop.database.mongodb.ConnectionManager
+MONGO_POOL_SIZE = 100
+MONGO_CONNECT_TIMEOUT_MS = 20000
+MONGO_SOCKET_TIMEOUT_MS = None
+MONGO_WAIT_QUEUE_TIMEOUT_MS = None
+# The replica set name, needed to read from secondaries
+MONGO_REPLICA_SET = None
+MONGO_READ_PREFERENCE = 'primary'
+MONGO_WRITE_CONCERN = {'w': 1}
+
+# Indexes are created on the first write to a bucket, each is a list of
+# fields in ascending order. The defaults only serve raw queries and
+# period queries without a group_by. BUCKET_INDEXES adds indexes for a
+# bucket, eg. {'licensing': [['authority', '_week_start_at']]}; the
+# index report suggests them for the queries it has seen miss.
+MONGO_INDEXES = [
+    ['_timestamp', '_id'],
+    ['_week_start_at'],
+    ['_month_start_at'],
+]
+BUCKET_INDEXES = {}
+# Note queries that no index can serve, see /bucket/<bucket_name>/indexes
+TRACK_INDEX_MISSES = False
 
 LOG_LEVEL = 'DEBUG'
+
+# Where to send stage timings: None, 'statsd', or 'prometheus' to
+# export them from /_metrics
+METRICS = None
+STATSD_HOST = 'localhost'
+STATSD_PORT = 8125
+STATSD_PREFIX = 'backdrop'
+# Send tags in the DogStatsD format rather than in metric names
+STATSD_TAGS = False
+PROMETHEUS_PREFIX = 'backdrop'
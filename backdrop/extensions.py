@@ -3,7 +3,7 @@ import functools
 
 from flask import current_app, jsonify
 
-from . import database
+from . import cache, database, groupcommit, metrics, spool
 from .bucket import Bucket, InvalidBucketError
 
 
@@ -22,6 +22,9 @@ class Database(object):
     def db(self):
         return current_app.extensions['backdrop.database']
 
+    def stats(self):
+        return self.db.connection_stats()
+
     def raw_queries_allowed(self, bucket_name):
         raw_queries_config = current_app.config.get('RAW_QUERIES_ALLOWED', {})
         return bool(raw_queries_config.get(bucket_name, False))
@@ -36,7 +39,10 @@ class Database(object):
                 kwargs['bucket'] = Bucket(
                     self.db,
                     bucket_name,
-                    self.raw_queries_allowed(bucket_name))
+                    self.raw_queries_allowed(bucket_name),
+                    current_app.extensions.get('backdrop.group_commit'),
+                    current_app.extensions.get('backdrop.spool'),
+                    current_app.config.get('SKIP_UNCHANGED_RECORDS', False))
 
                 return view(*args, **kwargs)
             except InvalidBucketError:
@@ -46,3 +52,66 @@ class Database(object):
 
         return wrapper
 
+
+class GroupCommit(object):
+    """Group commit of writes, for the write app only"""
+    def __init__(self, app):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['backdrop.group_commit'] = \
+            groupcommit.from_config(app.config)
+
+
+class Spool(object):
+    """The write spool, for the write app only"""
+    def __init__(self, app):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['backdrop.spool'] = spool.from_config(app.config)
+
+        if app.extensions['backdrop.spool']:
+            @app.before_first_request
+            def start_draining():
+                self.spool.start(current_app.extensions['backdrop.database'])
+
+    @property
+    def spool(self):
+        return current_app.extensions['backdrop.spool']
+
+    def stats(self):
+        return self.spool.stats() if self.spool else {'mode': None}
+
+
+class QueryCache(object):
+    def __init__(self, app):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['backdrop.cache'] = cache.from_config(app.config)
+
+    @property
+    def cache(self):
+        return current_app.extensions['backdrop.cache']
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class Metrics(object):
+    def __init__(self, app):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['backdrop.metrics'] = metrics.from_config(app.config)
@@ -0,0 +1,125 @@
+"""Group commit of small concurrent writes
+
+Collectors often post one record at a time. With group commit, records
+posted to a bucket at about the same time are stored together in one
+bulk write, and each request returns once that write is acknowledged.
+Only requests handled by the same process are combined, so this needs
+a threaded or evented server.
+"""
+import collections
+import itertools
+import threading
+import time
+
+from .bucket import store_batches
+
+
+def from_config(config):
+    if not config.get('GROUP_COMMIT'):
+        return None
+    return GroupCommit(config['GROUP_COMMIT_MAX_RECORDS'],
+                       config['GROUP_COMMIT_MAX_WAIT_MS'])
+
+
+class GroupCommit(object):
+    """Store the records of concurrent requests to a bucket together
+
+    The first request to find no open batch for its bucket leads a new
+    one. While other requests to the bucket are in progress, it waits
+    until the batch holds max_records or max_wait_ms has passed. It then
+    stores the batch while requests that joined it wait. A request alone
+    is stored straight away. A request whose records would take a batch
+    over max_records closes it and leads a new one, and a request with
+    max_records or more records is stored on its own.
+    """
+    def __init__(self, max_records=1000, max_wait_ms=5):
+        self._max_records = max_records
+        self._max_wait = max_wait_ms / 1000.0
+        self._lock = threading.Lock()
+        self._open = {}
+        self._active = collections.defaultdict(int)
+
+    def store(self, db, bucket_name, records):
+        """Store records, returning the counts inserted and updated
+
+        Records are read before joining a batch, so a request with an
+        invalid record fails on its own.
+        """
+        key = (db, bucket_name)
+        with self._lock:
+            self._active[key] += 1
+        try:
+            return self._store(key, records)
+        finally:
+            with self._lock:
+                self._active[key] -= 1
+                if not self._active[key]:
+                    del self._active[key]
+                if key in self._open:
+                    self._open[key].full.notify()
+
+    def _store(self, key, records):
+        db, bucket_name = key
+        records = iter(records)
+        head = list(itertools.islice(records, self._max_records))
+        if len(head) == self._max_records:
+            return store_batches(db, bucket_name,
+                                 [itertools.chain(head, records)])[0]
+
+        with self._lock:
+            batch = self._open.get(key)
+            if batch is not None and \
+                    batch.size + len(head) > self._max_records:
+                # Leave the batch to its leader to store now
+                del self._open[key]
+                batch.full.notify()
+                batch = None
+            is_leader = batch is None
+            if is_leader:
+                batch = self._open[key] = _Batch(self._lock)
+            index = batch.add(head)
+            batch.full.notify()
+
+        if is_leader:
+            self._lead(key, batch)
+        batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.counts[index]
+
+    def _lead(self, key, batch):
+        with self._lock:
+            deadline = time.time() + self._max_wait
+            while self._open.get(key) is batch and \
+                    batch.size < self._max_records and \
+                    self._active[key] > len(batch.records):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                batch.full.wait(remaining)
+            if self._open.get(key) is batch:
+                del self._open[key]
+
+        db, bucket_name = key
+        try:
+            batch.counts = store_batches(db, bucket_name, batch.records)
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+
+class _Batch(object):
+    def __init__(self, lock):
+        self.records = []
+        self.size = 0
+        self.full = threading.Condition(lock)
+        self.done = threading.Event()
+        self.counts = None
+        self.error = None
+
+    def add(self, records):
+        self.records.append(records)
+        self.size += len(records)
+        return len(self.records) - 1
@@ -1,9 +1,13 @@
+import codecs
 import json
 import datetime
+import re
 
 import bson
 from flask import current_app, request
 
+from .errors import ParseError
+
 
 class JsonEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -26,4 +30,131 @@ def jsonify(**data):
 
 
 def dumps(data, indent=False):
-    return json.dumps(data, cls=JsonEncoder, indent=2 if indent else None)
\ No newline at end of file
+    return json.dumps(data, cls=JsonEncoder, indent=2 if indent else None)
+
+
+def iterdumps(key, items, indent=False, chunk_size=64 * 1024, extra=None):
+    """Encode {key: list(items)} as dumps does, a chunk at a time
+
+    extra is called once the items are encoded and the keys and values
+    of the dict it returns are added to the object after key.
+    """
+    encoder = JsonEncoder(indent=2 if indent else None)
+    if indent:
+        end, outer, inner = '\n', '\n  ', '\n    '
+    else:
+        end, outer, inner = '', '', ''
+
+    chunk = ['{', outer, encoder.encode(key), encoder.key_separator, '[']
+    size = 0
+    separator = inner
+    for item in items:
+        encoded = encoder.encode(item).replace('\n', inner)
+        chunk += [separator, encoded]
+        size += len(encoded)
+        separator = encoder.item_separator + inner
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+
+    if separator != inner:
+        chunk.append(outer)
+    chunk.append(']')
+    for extra_key, value in (extra() if extra else {}).items():
+        chunk += [encoder.item_separator, outer, encoder.encode(extra_key),
+                  encoder.key_separator,
+                  encoder.encode(value).replace('\n', outer)]
+    chunk += [end, '}']
+    yield ''.join(chunk)
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER_CHARS = frozenset('0123456789.eE+-')
+
+
+def iterload(stream, chunk_size=64 * 1024):
+    """Lazily decode the items of a JSON array read from a stream
+
+    A document that is not an array is yielded as a single item.
+    """
+    return iter(_StreamDecoder(stream, chunk_size))
+
+
+class _StreamDecoder(object):
+    def __init__(self, stream, chunk_size):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._unicode_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = u''
+        self._pos = 0
+        self._eof = False
+
+    def __iter__(self):
+        if self._peek() != '[':
+            yield self._decode_value()
+            self._expect_end()
+            return
+
+        self._pos += 1
+        if self._peek() == ']':
+            self._pos += 1
+            self._expect_end()
+            return
+
+        while True:
+            yield self._decode_value()
+            char = self._peek()
+            self._pos += 1
+            if char == ']':
+                break
+            if char != ',':
+                raise ParseError('Invalid JSON: expected , or ]')
+        self._expect_end()
+
+    def _fill(self):
+        """Read the next chunk into the buffer, dropping consumed input"""
+        if self._eof:
+            return False
+        chunk = self._stream.read(self._chunk_size)
+        self._eof = not chunk
+        try:
+            text = self._unicode_decoder.decode(chunk, final=self._eof)
+        except UnicodeError:
+            raise ParseError('Non-UTF8 characters found.')
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+        return not self._eof
+
+    def _peek(self):
+        """Return the next non-whitespace character or None at the end"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return None
+
+    def _decode_value(self):
+        if self._peek() is None:
+            raise ParseError('Invalid JSON: unexpected end of input')
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                # The value may continue in the next chunk
+                if self._fill():
+                    continue
+                raise ParseError('Invalid JSON')
+            # A number at the end of the buffer may be truncated
+            if self._may_continue(end) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def _may_continue(self, end):
+        return end == len(self._buffer) or self._buffer[end] in _NUMBER_CHARS
+
+    def _expect_end(self):
+        if self._peek() is not None:
+            raise ParseError('Invalid JSON: unexpected data after the end')
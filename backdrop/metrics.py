@@ -0,0 +1,240 @@
+"""Timings and counts of the stages of handling requests
+
+Stages are timed with `timer` and events counted with `incr`. Both are
+tagged with the tags set by `tags` for the request being handled, the
+bucket and query type. METRICS configures where the metrics of each app
+go: nowhere, statsd over UDP, or 'prometheus' to keep them for /_metrics
+to export. Metrics recorded outside of an app context are dropped.
+Prometheus metrics are kept by each process, so with a preforking
+server a scrape only sees the worker that answers it; statsd gives the
+totals for all workers.
+"""
+import bisect
+import functools
+import socket
+import threading
+import time
+
+from flask import current_app, has_app_context
+
+
+# Upper bounds of the histogram buckets of timings, in seconds
+TIMING_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                  0.5, 1.0, 2.5, 5.0, 10.0]
+
+_local = threading.local()
+
+
+def from_config(config):
+    """A new backend for an app, see extensions.Metrics"""
+    backend = config.get('METRICS')
+    if backend is None:
+        return NullMetrics()
+    if backend == 'statsd':
+        return StatsdMetrics(config['STATSD_HOST'], config['STATSD_PORT'],
+                             config['STATSD_PREFIX'], config['STATSD_TAGS'])
+    if backend == 'prometheus':
+        return PrometheusMetrics(config['PROMETHEUS_PREFIX'])
+    raise ValueError('Unknown metrics backend "{0}"'.format(backend))
+
+
+def render():
+    """The metrics in the Prometheus text format, or None"""
+    return _backend().render()
+
+
+def _backend():
+    if has_app_context():
+        return current_app.extensions.get('backdrop.metrics', _null)
+    return _null
+
+
+def current_tags():
+    return getattr(_local, 'tags', {})
+
+
+class tags(object):
+    """Tag the metrics recorded by this thread within the block"""
+    def __init__(self, **tags):
+        self._tags = tags
+
+    def __enter__(self):
+        self._previous = current_tags()
+        _local.tags = dict(self._previous, **self._tags)
+
+    def __exit__(self, *exc_info):
+        _local.tags = self._previous
+
+
+class timer(object):
+    """Time the block as a stage"""
+    def __init__(self, name):
+        self._name = name
+
+    def __enter__(self):
+        self._started_at = time.time()
+
+    def __exit__(self, *exc_info):
+        _backend().timing(self._name, time.time() - self._started_at,
+                          current_tags())
+
+
+def timed(name):
+    """Time each call of the decorated function as a stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_iter(name, iterable):
+    """Time reading all of an iterable
+
+    The backend and tags are those when it is created, as a streamed
+    response is read after the request has been torn down.
+    """
+    backend, request_tags = _backend(), current_tags()
+
+    def timed():
+        started_at = time.time()
+        for item in iterable:
+            yield item
+        backend.timing(name, time.time() - started_at, request_tags)
+    return timed()
+
+
+def incr(name, value=1):
+    _backend().incr(name, value, current_tags())
+
+
+class NullMetrics(object):
+    def timing(self, name, seconds, tags):
+        pass
+
+    def incr(self, name, value, tags):
+        pass
+
+    def render(self):
+        return None
+
+
+class StatsdMetrics(object):
+    """Send metrics to statsd
+
+    Tags are sent in the DogStatsD format when use_tags is set, or
+    added to the name, eg. backdrop.query.parse.bucket.licensing.
+    """
+    def __init__(self, host, port, prefix, use_tags=False):
+        self._address = (host, port)
+        self._prefix = prefix
+        self._use_tags = use_tags
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def timing(self, name, seconds, tags):
+        self._send(name, '{0:.3f}|ms'.format(seconds * 1000), tags)
+
+    def incr(self, name, value, tags):
+        self._send(name, '{0}|c'.format(value), tags)
+
+    def render(self):
+        return None
+
+    def _send(self, name, value, tags):
+        name = '{0}.{1}'.format(self._prefix, name)
+        if self._use_tags:
+            packet = '{0}:{1}|#{2}'.format(name, value, ','.join(
+                '{0}:{1}'.format(key, tag) for key, tag in
+                sorted(tags.items())))
+        else:
+            packet = '{0}:{1}'.format('.'.join(
+                [name] + ['{0}.{1}'.format(key, tag) for key, tag in
+                          sorted(tags.items())]), value)
+        try:
+            self._socket.sendto(packet, self._address)
+        except socket.error:
+            pass
+
+
+class PrometheusMetrics(object):
+    """Keep metrics in this process for Prometheus to scrape
+
+    Timings are histograms in seconds and counts are counters.
+    """
+    def __init__(self, prefix):
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._counters = {}
+
+    def timing(self, name, seconds, tags):
+        key = (name, tuple(sorted(tags.items())))
+        with self._lock:
+            histogram = self._timings.get(key)
+            if histogram is None:
+                histogram = self._timings[key] = \
+                    [[0] * (len(TIMING_BUCKETS) + 1), 0.0]
+            histogram[0][bisect.bisect_left(TIMING_BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+
+    def incr(self, name, value, tags):
+        key = (name, tuple(sorted(tags.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self):
+        with self._lock:
+            timings = sorted(self._timings.items())
+            counters = sorted(self._counters.items())
+
+        lines = []
+        for name, series in _by_name(timings):
+            metric = self._metric_name(name) + '_seconds'
+            lines.append('# TYPE {0} histogram'.format(metric))
+            for tags, (counts, total) in series:
+                cumulative = 0
+                for bound, count in zip(TIMING_BUCKETS + ['+Inf'], counts):
+                    cumulative += count
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        metric, _labels(tags + (('le', bound),)),
+                        cumulative))
+                lines.append('{0}_sum{1} {2!r}'.format(
+                    metric, _labels(tags), total))
+                lines.append('{0}_count{1} {2}'.format(
+                    metric, _labels(tags), cumulative))
+        for name, series in _by_name(counters):
+            metric = self._metric_name(name) + '_total'
+            lines.append('# TYPE {0} counter'.format(metric))
+            for tags, value in series:
+                lines.append('{0}{1} {2}'.format(
+                    metric, _labels(tags), value))
+        return '\n'.join(lines) + '\n'
+
+    def _metric_name(self, name):
+        return '{0}_{1}'.format(self._prefix, name.replace('.', '_'))
+
+
+def _by_name(metrics):
+    series = []
+    for (name, tags), value in metrics:
+        if not series or series[-1][0] != name:
+            series.append((name, []))
+        series[-1][1].append((tags, value))
+    return series
+
+
+def _labels(tags):
+    if not tags:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(key, _escape(value)) for key, value in tags) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+_null = NullMetrics()
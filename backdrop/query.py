@@ -1,8 +1,21 @@
+import base64
+import json
 from collections import namedtuple
-from backdrop.errors import ValidationError
-from backdrop.validation import validate_query_args
 
-from .timeutils import parse_time_string
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from backdrop import metrics
+from backdrop.cache import LRUCache
+from backdrop.errors import ParseError, ValidationError
+from backdrop.validation import validate_query_args, \
+    validate_partial_query_args
+
+from .timeutils import parse_time_string, utc
+
+
+_PARSE_CACHE_SIZE = 1024
+_parse_cache = LRUCache(_PARSE_CACHE_SIZE)
 
 
 def if_present(func, value):
@@ -34,12 +47,39 @@ def parse_request_args(request_args):
 
     args['collect'] = request_args.getlist('collect')
 
+    args['after'] = if_present(decode_position, request_args.get('after'))
+
+    args['fields'] = request_args.getlist('fields')
+
     return args
 
 
+def encode_position(position):
+    """Encode the (_timestamp, _id) of a record as an opaque page token"""
+    timestamp, _id = position
+    if timestamp is not None:
+        timestamp = utc(timestamp).isoformat()
+    if isinstance(_id, ObjectId):
+        _id = ['oid', str(_id)]
+    return base64.urlsafe_b64encode(json.dumps([timestamp, _id]))
+
+
+def decode_position(token):
+    try:
+        timestamp, _id = json.loads(base64.urlsafe_b64decode(str(token)))
+        if timestamp is not None:
+            timestamp = parse_time_string(timestamp)
+        if isinstance(_id, list):
+            _id = ObjectId(_id[1])
+        return timestamp, _id
+    except (TypeError, ValueError, IndexError, AttributeError, InvalidId):
+        raise ParseError('after is not a valid page token')
+
+
 _Query = namedtuple(
     '_Query',
-    'start_at end_at filter_by period group_by sort_by limit collect'
+    'start_at end_at filter_by period group_by sort_by limit collect after '
+    'fields'
 )
 
 
@@ -47,17 +87,68 @@ class Query(_Query):
     @classmethod
     def create(cls,
                start_at=None, end_at=None, filter_by=None, period=None,
-               group_by=None, sort_by=None, limit=None, collect=None):
+               group_by=None, sort_by=None, limit=None, collect=None,
+               after=None, fields=None):
         return Query(start_at, end_at, filter_by or [], period,
-                     group_by, sort_by, limit, collect or [])
+                     group_by, sort_by, limit, collect or [], after,
+                     fields or [])
 
     @classmethod
-    def parse(cls, request_args):
-        result = validate_query_args(request_args)
+    def parse(cls, request_args, raw_queries_allowed=False):
+        """Validate and parse a query from request args
+
+        Parsed queries are memoized, dashboards send the same queries
+        over and over. Each caller gets its own copy of the lists in a
+        memoized query.
+        """
+        key = (_args_key(request_args), raw_queries_allowed)
+        query = _parse_cache.get(key)
+        if query is None:
+            metrics.incr('query.parse_cache.miss')
+            with metrics.timer('query.validate'):
+                result = validate_query_args(request_args,
+                                             raw_queries_allowed)
+            if not result.is_valid:
+                raise ValidationError(result.message)
+            query = Query(**parse_request_args(request_args))
+            _parse_cache.set(key, query._copy())
+        else:
+            metrics.incr('query.parse_cache.hit')
+            query = query._copy()
+        return query
+
+    @classmethod
+    def parse_partial(cls, request_args):
+        """Parse the time span requested from a partial query"""
+        result = validate_partial_query_args(request_args)
         if not result.is_valid:
             raise ValidationError(result.message)
         args = parse_request_args(request_args)
-        return Query(**args)
+        return Query.create(start_at=args['start_at'], end_at=args['end_at'])
+
+    def _copy(self):
+        return self._replace(
+            filter_by=[list(condition) for condition in self.filter_by],
+            sort_by=self.sort_by and list(self.sort_by),
+            collect=list(self.collect),
+            fields=list(self.fields))
+
+    @property
+    def page_size(self):
+        """The size of a page of records that can be resumed after"""
+        if self.is_raw_query and not self.sort_by:
+            return self.limit
+
+    @property
+    def query_type(self):
+        """The shape of the query, for metrics"""
+        if self.is_period_grouped_query:
+            return 'period_grouped'
+        if self.is_grouped_query:
+            return 'grouped'
+        if self.is_period_query:
+            return 'period'
+        return 'raw'
 
     @property
     def is_raw_query(self):
@@ -74,3 +165,8 @@ class Query(_Query):
     @property
     def is_period_query(self):
         return self.period
+
+
+def _args_key(request_args):
+    return tuple(sorted(
+        (key, tuple(values)) for key, values in request_args.lists()))
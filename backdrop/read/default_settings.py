@@ -2,3 +2,16 @@ RAW_QUERIES_ALLOWED = {
     'licensing_journey': True,
     'government_annotations': True,
 }
+
+# Reads are served by secondaries when MONGO_REPLICA_SET is set, except
+# for bucket versions which are always read from the primary
+MONGO_READ_PREFERENCE = 'secondary_preferred'
+
+# None, 'memory' for a cache per process or 'mmap' for one shared by all
+# worker processes through a file at QUERY_CACHE_PATH, suffixed with the
+# number of entries and the entry size
+QUERY_CACHE = None
+QUERY_CACHE_TTL = 300
+QUERY_CACHE_MAX_ENTRIES = 1024
+QUERY_CACHE_MAX_ENTRY_SIZE = 256 * 1024
+QUERY_CACHE_PATH = '/tmp/backdrop-query-cache'
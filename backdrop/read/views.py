@@ -1,11 +1,14 @@
-from flask import request
+from flask import abort, request
 from flask_negotiate import produces
 
-from . import app, db
-from backdrop.decorators import crossdomain
-from ..query import Query
+from . import app, db, query_cache
+from backdrop.decorators import crossdomain, conditional
+from .. import metrics
+from ..bucket import PartialNotFoundError
+from ..cache import cache_key
+from ..query import Query, encode_position
 from ..errors import ValidationError, ParseError
-from ..jsonutils import jsonify
+from ..jsonutils import jsonify, dumps, iterdumps
 
 
 @app.route('/_status')
@@ -13,20 +16,91 @@ def status():
     return "read status"
 
 
+@app.route('/_status/cache')
+def cache_status():
+    return jsonify(**query_cache.stats())
+
+
+@app.route('/_status/database')
+def database_status():
+    return jsonify(**db.stats())
+
+
+@app.route('/_metrics')
+def metrics_export():
+    body = metrics.render()
+    if body is None:
+        abort(404)
+    return app.response_class(body, mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/<bucket_name>')
 @produces('application/json')
 @crossdomain(origin='*')
 @db.load_bucket
-def do_query(bucket):
+@conditional
+def do_query(bucket, version):
+    with metrics.tags(bucket=bucket.name):
+        try:
+            with metrics.timer('query.parse'):
+                query = Query.parse(request.args, bucket.allow_raw_queries)
+
+            with metrics.tags(query_type=query.query_type):
+                return _query_response(bucket, version, query)
+        except (ParseError, ValidationError) as e:
+            metrics.incr('query.invalid')
+            return jsonify(status='error',
+                           message=str(e)), 400
+
+
+def _query_response(bucket, version, query):
+    if query.is_raw_query:
+        # Raw results are streamed from the cursor and never cached
+        result = bucket.query(query)
+        return app.response_class(
+            metrics.timed_iter('response.stream', iterdumps(
+                'data', result.iter_data(), request.is_xhr,
+                extra=lambda: _next_page(result))),
+            mimetype='application/json')
+
+    key = cache_key(bucket.name, version.generation, query,
+                    request.is_xhr)
+    body = query_cache.get(key)
+    if body is None:
+        metrics.incr('query.cache.miss')
+        result = bucket.query(query)
+        with metrics.timer('response.encode'):
+            body = dumps({'data': result.data()}, request.is_xhr)
+        query_cache.set(key, body)
+    else:
+        metrics.incr('query.cache.hit')
+
+    return app.response_class(body, mimetype='application/json')
+
+
+def _next_page(result):
+    position = result.next_position()
+    if position:
+        return {'next': encode_position(position)}
+    return {}
+
+
+@app.route('/<bucket_name>/<partial_name>')
+@produces('application/json')
+@crossdomain(origin='*')
+@db.load_bucket
+@conditional
+def partial_query(bucket, version, partial_name):
     try:
-        result = bucket.query(Query.parse(request.args))
+        with metrics.tags(bucket=bucket.name, query_type='partial'):
+            result = bucket.query_partial(partial_name,
+                                          Query.parse_partial(request.args))
 
-        return jsonify(data=result.data())
+            with metrics.timer('response.encode'):
+                return jsonify(data=result.data())
     except (ParseError, ValidationError) as e:
         return jsonify(status='error',
                        message=str(e)), 400
-
-
-@app.route('/<bucket_name>/<partial_name>')
-def partial_query(bucket_name, partial_name):
-    pass
\ No newline at end of file
+    except PartialNotFoundError as e:
+        return jsonify(status='error',
+                       message=str(e)), 404
\ No newline at end of file
@@ -1,5 +1,8 @@
 """Records that can be saved to buckets or partial query stores
 """
+import hashlib
+import json
+
 from . import timeutils
 from .timeseries import WEEK, MONTH
 from .validation import validate_record_data
@@ -10,26 +13,61 @@ def parse_all(data):
     if not isinstance(data, list):
         data = [data]
 
-    return [parse(datum) for datum in data]
+    builder = RecordBuilder()
+    return [builder.parse(datum) for datum in data]
+
+
+def parse_stream(data):
+    """Lazily parse Records from an iterable of python objects"""
+    builder = RecordBuilder()
+    for datum in data:
+        yield builder.parse(datum)
 
 
 def parse(datum):
     """Parse a Record from a python object"""
-    if '_timestamp' in datum:
-        try:
-            datum['_timestamp'] = timeutils.parse_time_string(
-                datum['_timestamp'])
-        except ValueError:
-            raise ParseError(
-                '_timestamp is not a valid timestamp, it must be ISO8601')
+    return RecordBuilder().parse(datum)
+
+
+class RecordBuilder(object):
+    """Parses the Records of a batch
+
+    Records in a batch mostly fall on a few days, so the start of the
+    week and month are worked out once for each day.
+    """
+
+    def __init__(self):
+        self._period_starts = {}
+
+    def parse(self, datum):
+        if '_timestamp' in datum:
+            try:
+                datum['_timestamp'] = timeutils.parse_time_string(
+                    datum['_timestamp'])
+            except ValueError:
+                raise ParseError(
+                    '_timestamp is not a valid timestamp, it must be ISO8601')
+
+        return Record(datum, self.period_starts)
+
+    def period_starts(self, timestamp):
+        key = (timestamp.date(), timestamp.tzinfo)
+        starts = self._period_starts.get(key)
+        if starts is None:
+            starts = self._period_starts[key] = period_starts(timestamp)
+        return starts
 
-    return Record(datum)
+
+def period_starts(timestamp):
+    """The start of the week and month a timestamp falls in"""
+    return WEEK.start(timestamp), MONTH.start(timestamp)
 
 
 class Record(object):
     """A record that can be saved to a bucket"""
+    __slots__ = ('data', 'meta')
 
-    def __init__(self, data):
+    def __init__(self, data, period_starts=period_starts):
         result = validate_record_data(data)
         if not result.is_valid:
             raise ValidationError(result.message)
@@ -38,16 +76,49 @@ class Record(object):
         self.meta = {}
 
         if "_timestamp" in self.data:
-            self.meta['_week_start_at'] = WEEK.start(self.data['_timestamp'])
-            self.meta['_month_start_at'] = MONTH.start(self.data['_timestamp'])
+            self.meta['_week_start_at'], self.meta['_month_start_at'] = \
+                period_starts(self.data['_timestamp'])
 
     def add_updated_at(self):
         self.meta['_updated_at'] = timeutils.now()
         return self
 
+    def add_hash(self):
+        """Add a digest of the data, so stores can skip unchanged records"""
+        self.meta['_hash'] = hashlib.md5(json.dumps(
+            self.data, sort_keys=True, separators=(',', ':'),
+            default=_isoformat)).hexdigest()
+        return self
+
     def to_dict(self):
-        return dict(self.data.items() + self.meta.items())
+        doc = dict(self.data)
+        doc.update(self.meta)
+        return doc
+
+
+def _isoformat(value):
+    return value.isoformat()
+
+
+def aggregate(keys, data):
+    """Count storage dicts into one AggregateRecord per group of keys
+
+    Records without a value for each of the keys are not counted, in the
+    same way as group queries ignore them.
+    """
+    counts = {}
+    for datum in data:
+        group = tuple(datum.get(key) for key in keys)
+        if None not in group:
+            counts[group] = counts.get(group, 0) + 1
+
+    return [AggregateRecord(zip(keys, group), count)
+            for group, count in counts.items()]
 
 
 class AggregateRecord(object):
-    """An aggregated record that can be saved in a partial query store"""
\ No newline at end of file
+    """An aggregated record that can be saved in a partial query store"""
+
+    def __init__(self, group, count):
+        self.group = list(group)
+        self.count = count
\ No newline at end of file
@@ -1,22 +1,17 @@
-import datetime
-
 import pytz
-from dateutil.relativedelta import relativedelta
 
-from .timeseries import timeseries, WEEK, MONTH
+from . import metrics
+from .database import aggregations
+from .timeseries import timeseries, PERIODS
 
 
 def build_period_group_response(query, data):
-    if query.period == "month":
-        results = MonthlyGroupedData(data)
-    else:
-        results = WeeklyGroupedData(data)
-
-    if query.start_at and query.end_at and query.period == "week":
-        results.fill_missing_weeks(query.start_at, query.end_at)
+    results = PeriodGroupedData(data, period=query.period)
 
-    if query.start_at and query.end_at and query.period == "month":
-        results.fill_missing_months(query.start_at, query.end_at)
+    if query.start_at and query.end_at:
+        with metrics.timer('response.fill_periods'):
+            results.fill_missing_periods(query.start_at, query.end_at,
+                                         query.collect)
 
     return results
 
@@ -29,58 +24,63 @@ def build_period_response(query, data):
     results = PeriodData(data, period=query.period)
 
     if query.start_at and query.end_at:
-        results.fill_missing_periods(query.start_at, query.end_at)
+        with metrics.timer('response.fill_periods'):
+            results.fill_missing_periods(query.start_at, query.end_at,
+                                         query.collect)
 
     return results
 
 
-def build_simple_response(data):
-    return SimpleData(data)
+def build_simple_response(query, data):
+    return SimpleData(data, page_size=query.page_size, fields=query.fields)
 
 
-def create_period_group(doc):
-    if "_week_start_at" not in doc or "_count" not in doc:
+def create_period_group(doc, period="week"):
+    period = PERIODS[period]
+    if period.key not in doc or "_count" not in doc:
         raise ValueError("Expected subgroup to have keys '_count'"
-                         " and '_week_start_at'")
-    if doc["_week_start_at"].weekday() is not 0:
-        raise ValueError("Weeks MUST start on Monday but "
-                         "got date: %s" % doc["_week_start_at"])
-    datum = {}
-    datum["_start_at"] = doc["_week_start_at"].replace(tzinfo=pytz.utc)
-    datum["_end_at"] = datum["_start_at"] + datetime.timedelta(days=7)
-    datum["_count"] = doc["_count"]
-    return datum
-
-
-def create_period_group_month(doc):
-    if "_month_start_at" not in doc or "_count" not in doc:
-        raise ValueError("Expected subgroup to have keys '_count' and "
-                         "'_month_start_at'")
-    if doc["_month_start_at"].day != 1:
-        raise ValueError("Months MUST start on the 1st but "
-                         "got date: %s" % doc["_month_start_at"])
-    datum = {}
-    datum["_start_at"] = doc["_month_start_at"].replace(tzinfo=pytz.utc)
-    datum["_end_at"] = (doc["_month_start_at"]
-                        + relativedelta(months=1)).replace(tzinfo=pytz.UTC)
-    datum["_count"] = doc["_count"]
+                         " and '{0}'".format(period.key))
+    if not period.is_boundary(doc[period.key]):
+        raise ValueError("A {0} MUST start at the start of the {0} but "
+                         "got date: {1}".format(period.name, doc[period.key]))
+    datum = dict((key, value) for key, value in doc.items()
+                 if key != period.key)
+    datum["_start_at"] = doc[period.key].replace(tzinfo=pytz.utc)
+    datum["_end_at"] = datum["_start_at"] + period.delta
     return datum
 
 
 class SimpleData(object):
-    def __init__(self, cursor):
-        self._data = []
-        for doc in cursor:
-            self.__add(doc)
-
-    def __add(self, document):
+    """Documents read lazily from a cursor, which can only be read once"""
+    def __init__(self, cursor, page_size=None, fields=None):
+        self._cursor = cursor
+        self._page_size = page_size
+        self._fields = fields
+        self._count = 0
+        self._last = None
+
+    def __normalize(self, document):
+        if self._fields:
+            document = dict((key, value) for key, value in document.items()
+                            if key in self._fields)
         if "_timestamp" in document:
             document["_timestamp"] = \
                 document["_timestamp"].replace(tzinfo=pytz.utc)
-        self._data.append(document)
+        return document
+
+    def iter_data(self):
+        for doc in self._cursor:
+            self._count += 1
+            self._last = doc
+            yield self.__normalize(doc)
 
     def data(self):
-        return tuple(self._data)
+        return tuple(self.iter_data())
+
+    def next_position(self):
+        """Where the next page starts, if the data read was a full page"""
+        if self._page_size and self._count == self._page_size:
+            return self._last.get("_timestamp"), self._last["_id"]
 
 
 class PeriodData(object):
@@ -91,29 +91,19 @@ class PeriodData(object):
             self.__add(doc)
 
     def __add(self, document):
-        self._data.append(self.__create_datum(document))
+        self._data.append(create_period_group(document, self.period))
 
     def data(self):
         return tuple(self._data)
 
-    def fill_missing_periods(self, start, end):
-        periods = {
-            "week": WEEK,
-            "month": MONTH
-        }
+    def fill_missing_periods(self, start, end, collect=()):
+        default = aggregations.empty_values(collect)
+        default["_count"] = 0
         self._data = timeseries(start=start,
                                 end=end,
-                                period=periods[self.period],
+                                period=PERIODS[self.period],
                                 data=self._data,
-                                default={"_count": 0})
-
-    def __create_datum(self, doc):
-        datum = {}
-        if self.period == "week":
-            datum = create_period_group(doc)
-        if self.period == "month":
-            datum = create_period_group_month(doc)
-        return datum
+                                default=default)
 
 
 class GroupedData(object):
@@ -129,51 +119,20 @@ class GroupedData(object):
         return tuple(self._data)
 
 
-class WeeklyGroupedData(object):
-    def __init__(self, cursor):
-        self._data = []
-        for doc in cursor:
-            self.__add(doc)
-
-    def __add(self, datum):
-        if "_subgroup" not in datum:
-            raise ValueError("Expected document to have key '_subgroup'")
-
-        _datum = {}
-        _datum.update({
-            "values":
-                [create_period_group(entry) for entry in datum["_subgroup"]]})
-        del datum['_subgroup']
-        _datum.update(datum)
-        self._data.append(_datum)
-
-    def data(self):
-        return tuple(self._data)
-
-    def fill_missing_weeks(self, start_date, end_date):
-        for i, _ in enumerate(self._data):
-            self._data[i]['values'] = timeseries(
-                start=start_date,
-                end=end_date,
-                period=WEEK,
-                data=self._data[i]['values'],
-                default={"_count": 0}
-            )
-
-
-class MonthlyGroupedData(object):
-    def __init__(self, cursor):
+class PeriodGroupedData(object):
+    def __init__(self, cursor, period):
+        self.period = period
         self._data = []
         for doc in cursor:
             self.__add(doc)
 
     def __add(self, doc):
-        if '_subgroup' not in doc:
+        if "_subgroup" not in doc:
             raise ValueError("Expected document to have key '_subgroup'")
         datum = {}
         datum.update({
-            "values": [create_period_group_month(subgroup) for
-                       subgroup in doc["_subgroup"]]})
+            "values": [create_period_group(subgroup, self.period)
+                       for subgroup in doc["_subgroup"]]})
         del doc["_subgroup"]
         datum.update(doc)
         self._data.append(datum)
@@ -181,12 +140,14 @@ class MonthlyGroupedData(object):
     def data(self):
         return tuple(self._data)
 
-    def fill_missing_months(self, start_date, end_date):
+    def fill_missing_periods(self, start_date, end_date, collect=()):
+        default = aggregations.empty_values(collect, subgroups=True)
+        default["_count"] = 0
         for i, _ in enumerate(self._data):
             self._data[i]['values'] = timeseries(
                 start=start_date,
                 end=end_date,
-                period=MONTH,
+                period=PERIODS[self.period],
                 data=self._data[i]['values'],
-                default={"_count": 0}
+                default=default
             )
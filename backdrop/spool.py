@@ -0,0 +1,452 @@
+"""A local spool of records for when the database is unavailable
+
+Records are appended to segment files in SPOOL_PATH as BSON documents
+and replayed into the database, in the order they were spooled, by a
+drainer thread in each write process. Only one process drains at a time.
+
+In 'fallback' mode records are spooled when storing them cannot reach
+the database, and while there is a backlog so that they stay in order.
+In 'async' mode they are always spooled.
+
+An entry that was partly stored before the database became unavailable,
+or that is replayed again after a crash, has its records stored again.
+Records with an _id replace themselves, records without one are
+duplicated.
+
+Replaying is retried for as long as the database is unreachable, and up
+to SPOOL_REPLAY_ATTEMPTS times for other database errors. Records that
+still cannot be stored are appended to the dead letter file in SPOOL_PATH,
+in the same format as the segments, rather than dropped.
+"""
+import contextlib
+import fcntl
+import itertools
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+import bson
+from bson.errors import InvalidBSON
+from pymongo.errors import ConnectionFailure, PyMongoError
+
+from .bucket import store_batches
+from .errors import BackdropError
+from .record import Record
+
+
+SEGMENT_SUFFIX = '.spool'
+DEAD_LETTER = 'dead-letter.bson'
+FSYNC_POLICIES = ['always', 'interval', 'never']
+
+
+def from_config(config):
+    mode = config.get('SPOOL')
+    if mode is None:
+        return None
+    return Spool(config['SPOOL_PATH'], mode,
+                 fsync=config['SPOOL_FSYNC'],
+                 fsync_interval=config['SPOOL_FSYNC_INTERVAL'],
+                 max_bytes=config['SPOOL_MAX_BYTES'],
+                 segment_bytes=config['SPOOL_SEGMENT_BYTES'],
+                 batch_records=config['SPOOL_BATCH_RECORDS'],
+                 drain_interval=config['SPOOL_DRAIN_INTERVAL'],
+                 replay_attempts=config['SPOOL_REPLAY_ATTEMPTS'])
+
+
+class SpoolFullError(BackdropError):
+    pass
+
+
+class Spool(object):
+    def __init__(self, path, mode, fsync='always', fsync_interval=1.0,
+                 max_bytes=1024 ** 3, segment_bytes=64 * 1024 ** 2,
+                 batch_records=1000, drain_interval=1.0,
+                 replay_attempts=10):
+        if mode not in ('fallback', 'async'):
+            raise ValueError('Unknown spool mode "{0}"'.format(mode))
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown spool fsync policy "{0}"'.format(fsync))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self._path = path
+        self._mode = mode
+        self._fsync = fsync
+        self._fsync_interval = fsync_interval
+        self._max_bytes = max_bytes
+        self._segment_bytes = segment_bytes
+        self._batch_records = batch_records
+        self._drain_interval = drain_interval
+        self._replay_attempts = replay_attempts
+
+        self._lock = threading.Lock()
+        self._db = None
+        self._drainer_pid = None
+        self._pid = None
+        self._segment = None
+        self._segment_fd = None
+        self._synced_at = 0
+        self._unsynced = False
+
+        self._spooled = 0
+        self._replayed = 0
+        self._failed_attempts = 0
+        self._dead_lettered = 0
+        self._drain_errors = 0
+        self._last_drain_error = None
+
+    def store(self, db, bucket_name, records, store):
+        """Store records by calling store, or spool them
+
+        Returns the counts store returns, or the number of records
+        spooled.
+        """
+        self.start(db)
+
+        if self._mode == 'async' or self.backlog_bytes():
+            return self.spool(bucket_name, records)
+
+        consumed = []
+
+        def consume(records):
+            for record in records:
+                consumed.append(record)
+                yield record
+
+        try:
+            return store(consume(records))
+        except ConnectionFailure as e:
+            logging.warning("Spooling records for %s: %s", bucket_name, e)
+            return self.spool(bucket_name,
+                              itertools.chain(consumed, records))
+
+    def spool(self, bucket_name, records):
+        spooled = 0
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, self._batch_records))
+            if not batch:
+                break
+            self._append(_encode(bucket_name, batch))
+            spooled += len(batch)
+        self._spooled += spooled
+        return {'spooled': spooled}
+
+    def backlog_bytes(self):
+        """The size of the entries not yet replayed"""
+        segment, offset = self._position()
+        return sum(os.path.getsize(self._segment_path(name))
+                   for name in self._segments()) - offset
+
+    def stats(self):
+        return {
+            'mode': self._mode,
+            'segments': len(self._segments()),
+            'backlog_bytes': self.backlog_bytes(),
+            'max_bytes': self._max_bytes,
+            'spooled_records': self._spooled,
+            'replayed_records': self._replayed,
+            'dead_letter_records': self._dead_lettered,
+            'drain_errors': self._drain_errors,
+            'last_drain_error': self._last_drain_error,
+        }
+
+    def drain(self, db):
+        """Replay spooled entries into db unless another process is"""
+        with self._file_lock('drain.lock', blocking=False) as locked:
+            if not locked:
+                return
+            for name in self._segments():
+                segment, offset = self._position()
+                if segment != name:
+                    offset = 0
+                offset = self._replay(db, name, offset)
+                if not self._remove_if_drained(name, offset):
+                    return
+
+    def _replay(self, db, name, offset):
+        bucket_name, records = None, []
+        try:
+            for end, entry in _read_entries(self._segment_path(name), offset):
+                if records and (entry['bucket'] != bucket_name or
+                                len(records) >= self._batch_records):
+                    self._replay_records(db, bucket_name, records)
+                    self._save_position(name, offset)
+                    records = []
+                bucket_name = entry['bucket']
+                records.extend(_decode(entry))
+                offset = end
+        except InvalidBSON:
+            logging.error("Spool segment %s is corrupt after offset %d",
+                          name, offset)
+            if records:
+                self._replay_records(db, bucket_name, records)
+            offset = os.path.getsize(self._segment_path(name))
+            self._save_position(name, offset)
+            return offset
+
+        if records:
+            self._replay_records(db, bucket_name, records)
+            self._save_position(name, offset)
+        return offset
+
+    def _replay_records(self, db, bucket_name, records):
+        """Store records, raising to retry them on the next drain"""
+        try:
+            store_batches(db, bucket_name, [records])
+        except ConnectionFailure:
+            raise
+        except PyMongoError:
+            self._failed_attempts += 1
+            if self._failed_attempts < self._replay_attempts:
+                raise
+            self._dead_letter(bucket_name, records)
+        except Exception:
+            self._dead_letter(bucket_name, records)
+        else:
+            self._replayed += len(records)
+        self._failed_attempts = 0
+
+    def _dead_letter(self, bucket_name, records):
+        logging.exception("Moving %d spooled records for %s to %s",
+                          len(records), bucket_name, DEAD_LETTER)
+        with open(os.path.join(self._path, DEAD_LETTER), 'ab') as f:
+            f.write(_encode(bucket_name, records))
+            if self._fsync != 'never':
+                f.flush()
+                os.fsync(f.fileno())
+        self._dead_lettered += len(records)
+
+    def _remove_if_drained(self, name, offset):
+        """Remove a segment once every entry in it has been replayed
+
+        Entries are only incomplete at the end of the newest segment
+        while they are being written, anywhere else they were torn by a
+        crash and are skipped.
+        """
+        with self._append_lock():
+            path = self._segment_path(name)
+            size = os.path.getsize(path)
+            if offset < size and name == self._segments()[-1]:
+                return False
+            if offset < size:
+                logging.error("Skipping %d bytes torn from the end of "
+                              "spool segment %s", size - offset, name)
+            os.remove(path)
+            self._save_position(None, 0)
+            return True
+
+    def _append(self, data):
+        with self._append_lock():
+            if self.backlog_bytes() + len(data) > self._max_bytes:
+                raise SpoolFullError('The write spool is full')
+
+            fd = self._writable_segment(len(data))
+            written = 0
+            while written < len(data):
+                written += os.write(fd, data[written:])
+
+            self._unsynced = True
+            if self._fsync == 'always':
+                self._sync()
+            else:
+                self._sync_if_due()
+
+    def _writable_segment(self, size):
+        """Open the newest segment, or start a new one
+
+        All processes append to the newest segment so entries are
+        replayed in the order they were spooled. A process starts a new
+        segment when it first appends, and rather than append after an
+        entry torn by a crash.
+        """
+        segments = self._segments()
+        newest = segments[-1] if segments else None
+        if self._segment_fd is None or self._pid != os.getpid():
+            self._open_segment(None)
+        elif self._segment != newest:
+            if newest and _is_complete(self._segment_path(newest)):
+                self._open_segment(newest)
+            else:
+                self._open_segment(None)
+
+        if os.fstat(self._segment_fd).st_size + size > self._segment_bytes:
+            self._open_segment(None)
+        return self._segment_fd
+
+    def _open_segment(self, name):
+        if self._segment_fd is not None and self._pid == os.getpid():
+            self._sync()
+            os.close(self._segment_fd)
+
+        if name is None:
+            segments = self._segments()
+            number = int(time.time() * 1000000)
+            if segments:
+                number = max(number, int(segments[-1]) + 1)
+            name = '{0:020d}'.format(number)
+
+        self._segment = name
+        self._segment_fd = os.open(self._segment_path(name),
+                                   os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                   0o644)
+        self._pid = os.getpid()
+        if self._fsync != 'never':
+            _fsync_directory(self._path)
+
+    def _sync(self):
+        if self._unsynced and self._segment_fd is not None:
+            os.fsync(self._segment_fd)
+        self._unsynced = False
+        self._synced_at = time.time()
+
+    def _sync_if_due(self):
+        if self._fsync == 'interval' and \
+                time.time() - self._synced_at >= self._fsync_interval:
+            self._sync()
+
+    def _segments(self):
+        return sorted(filename[:-len(SEGMENT_SUFFIX)]
+                      for filename in os.listdir(self._path)
+                      if filename.endswith(SEGMENT_SUFFIX))
+
+    def _segment_path(self, name):
+        return os.path.join(self._path, name + SEGMENT_SUFFIX)
+
+    def _position(self):
+        """The segment being drained and the offset replayed up to"""
+        try:
+            with open(os.path.join(self._path, 'drain.position')) as f:
+                position = json.load(f)
+        except (IOError, ValueError):
+            return None, 0
+        if position['segment'] not in self._segments():
+            return None, 0
+        return position['segment'], position['offset']
+
+    def _save_position(self, name, offset):
+        path = os.path.join(self._path, 'drain.position')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'segment': name, 'offset': offset}, f)
+            if self._fsync != 'never':
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+
+    @contextlib.contextmanager
+    def _append_lock(self):
+        with self._lock:
+            with self._file_lock('append.lock') as locked:
+                yield locked
+
+    @contextlib.contextmanager
+    def _file_lock(self, name, blocking=True):
+        fd = os.open(os.path.join(self._path, name),
+                     os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX |
+                            (0 if blocking else fcntl.LOCK_NB))
+            except IOError:
+                yield False
+                return
+            yield True
+        finally:
+            os.close(fd)
+
+    def start(self, db):
+        """Drain into db from a thread of this process
+
+        The thread is started again in a process forked after it.
+        """
+        self._db = db
+        if self._drainer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._drainer_pid != os.getpid():
+                drainer = threading.Thread(target=self._drain_forever,
+                                           name='spool-drainer')
+                drainer.daemon = True
+                drainer.start()
+                self._drainer_pid = os.getpid()
+
+    def _drain_forever(self):
+        while True:
+            try:
+                self.drain(self._db)
+            except PyMongoError as e:
+                self._drain_errors += 1
+                self._last_drain_error = str(e)
+                logging.warning("Database unavailable to drain spool: %s", e)
+            except Exception as e:
+                self._drain_errors += 1
+                self._last_drain_error = str(e)
+                logging.exception("Draining the spool failed")
+
+            if self._fsync == 'interval':
+                with self._lock:
+                    self._sync_if_due()
+            time.sleep(self._drain_interval)
+
+
+def _encode(bucket_name, records):
+    return bson.BSON.encode({
+        'bucket': bucket_name,
+        'records': [record.data for record in records],
+        'meta': [record.meta for record in records],
+    })
+
+
+def _decode(entry):
+    records = []
+    for data, meta in zip(entry['records'], entry['meta']):
+        record = Record(data)
+        record.meta.update(meta)
+        records.append(record)
+    return records
+
+
+def _read_entries(path, offset):
+    """Yield the offset after each complete entry and the entry"""
+    with open(path, 'rb') as segment:
+        segment.seek(offset)
+        while True:
+            header = segment.read(4)
+            if len(header) < 4:
+                return
+            size = struct.unpack('<i', header)[0]
+            if size < 5:
+                raise InvalidBSON('Invalid entry size {0}'.format(size))
+            body = segment.read(size - 4)
+            if len(body) < size - 4:
+                return
+            offset += size
+            yield offset, bson.BSON(header + body).decode(tz_aware=True)
+
+
+def _is_complete(path):
+    """Whether a segment ends with a complete entry"""
+    size = os.path.getsize(path)
+    offset = 0
+    with open(path, 'rb') as segment:
+        while offset < size:
+            header = segment.read(4)
+            if len(header) < 4:
+                return False
+            entry_size = struct.unpack('<i', header)[0]
+            if entry_size < 5:
+                return False
+            offset += entry_size
+            segment.seek(offset)
+    return offset == size
+
+
+def _fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
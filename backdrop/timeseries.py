@@ -1,62 +1,100 @@
-from datetime import timedelta, time
+import abc
+from datetime import timedelta
 import time as _time
 from dateutil.relativedelta import relativedelta, MO
 import pytz
 
 
-class Week(object):
-    def __init__(self):
-        self._delta = timedelta(days=7)
+class Period(object):
+    """A span of time that timestamps are grouped into
+
+    Rows grouped by a period hold its start under the period's key.
+    """
+    __metaclass__ = abc.ABCMeta
 
+    def __init__(self, name, delta):
+        self.name = name
+        self.key = '_{0}_start_at'.format(name)
+        self.delta = delta
+
+    @abc.abstractmethod
     def start(self, timestamp):
-        return _truncate_time(timestamp) + relativedelta(weekday=MO(-1))
+        """The start of the period that timestamp falls in"""
+
+    def is_boundary(self, timestamp):
+        return self.start(timestamp) == timestamp
 
     def end(self, timestamp):
-        if self._monday_midnight(timestamp):
+        if self.is_boundary(timestamp):
             return timestamp
-        return self.start(timestamp) + self._delta
+        return self.start(timestamp) + self.delta
 
     def range(self, start, end):
         _start = self.start(start).replace(tzinfo=pytz.utc)
         _end = self.end(end).replace(tzinfo=pytz.utc)
         while _start < _end:
-            yield (_start, _start + self._delta)
-            _start += self._delta
+            yield (_start, _start + self.delta)
+            _start += self.delta
+
 
-    def _monday_midnight(self, timestamp):
-        return timestamp.weekday() == 0 \
-            and timestamp.time() == time(0, 0, 0, 0)
+class Hour(Period):
+    def __init__(self):
+        super(Hour, self).__init__('hour', timedelta(hours=1))
 
+    def start(self, timestamp):
+        return timestamp.replace(minute=0, second=0, microsecond=0)
 
-class Month(object):
+
+class Day(Period):
     def __init__(self):
-        self._delta = relativedelta(months=1)
+        super(Day, self).__init__('day', timedelta(days=1))
+
+    def start(self, timestamp):
+        return _truncate_time(timestamp)
 
-    def is_month_boundary(self, t):
-        return t.day == 1 and t.time() == time(0, 0, 0, 0)
+
+class Week(Period):
+    def __init__(self):
+        super(Week, self).__init__('week', timedelta(days=7))
 
     def start(self, timestamp):
-        return timestamp.replace(day=1,
-                                 hour=0,
-                                 minute=0,
-                                 second=0,
-                                 microsecond=0)
+        return _truncate_time(timestamp) + relativedelta(weekday=MO(-1))
 
-    def end(self, timestamp):
-        if self.is_month_boundary(timestamp):
-                return timestamp
-        return self.start(timestamp + self._delta)
 
-    def range(self, start, end):
-        _start = self.start(start).replace(tzinfo=pytz.UTC)
-        _end = self.end(end).replace(tzinfo=pytz.UTC)
-        while (_start < _end):
-            yield (_start, _start + self._delta)
-            _start += self._delta
+class Month(Period):
+    def __init__(self):
+        super(Month, self).__init__('month', relativedelta(months=1))
+
+    def start(self, timestamp):
+        return _truncate_time(timestamp).replace(day=1)
 
 
+class Quarter(Period):
+    def __init__(self):
+        super(Quarter, self).__init__('quarter', relativedelta(months=3))
+
+    def start(self, timestamp):
+        return _truncate_time(timestamp).replace(
+            month=timestamp.month - (timestamp.month - 1) % 3, day=1)
+
+
+class Year(Period):
+    def __init__(self):
+        super(Year, self).__init__('year', relativedelta(years=1))
+
+    def start(self, timestamp):
+        return _truncate_time(timestamp).replace(month=1, day=1)
+
+
+HOUR = Hour()
+DAY = Day()
 WEEK = Week()
 MONTH = Month()
+QUARTER = Quarter()
+YEAR = Year()
+
+PERIODS = dict((period.name, period)
+               for period in [HOUR, DAY, WEEK, MONTH, QUARTER, YEAR])
 
 
 def _time_to_index(dt):
@@ -1,8 +1,18 @@
 import datetime
+import re
+
 from dateutil import parser
 import pytz
 
 
+ISO_8601_RE = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?'
+    r'(?:(Z)|([+-])(\d{2}):?(\d{2}))$')
+
+_PARSE_CACHE_SIZE = 4096
+_parse_cache = {}
+
+
 def now():
     return datetime.datetime.now(pytz.UTC)
 
@@ -10,8 +20,46 @@ def now():
 def parse_time_string(time_string, default=None):
     if time_string is None:
         return default
-    time = parser.parse(time_string)
-    return time.astimezone(pytz.utc)
+    return parse_iso(time_string).astimezone(pytz.utc)
+
+
+def parse_iso(time_string):
+    """Parse a timestamp keeping the offset it was given in
+
+    Timestamps in the strict ISO 8601 form the API documents are parsed
+    directly, anything else falls back to dateutil. Results are memoized
+    as the same timestamps are parsed repeatedly while validating and
+    parsing a query.
+    """
+    time = _parse_cache.get(time_string)
+    if time is None:
+        match = ISO_8601_RE.match(time_string)
+        if match:
+            time = _from_match(match)
+        else:
+            time = parser.parse(time_string)
+
+        if len(_parse_cache) >= _PARSE_CACHE_SIZE:
+            _parse_cache.clear()
+        _parse_cache[time_string] = time
+    return time
+
+
+def _from_match(match):
+    (year, month, day, hour, minute, second, fraction,
+     zulu, sign, offset_hours, offset_minutes) = match.groups()
+
+    if zulu:
+        tz = pytz.UTC
+    else:
+        offset = int(offset_hours) * 60 + int(offset_minutes)
+        tz = pytz.FixedOffset(offset if sign == '+' else -offset)
+
+    return datetime.datetime(
+        int(year), int(month), int(day),
+        int(hour), int(minute), int(second),
+        int(fraction.ljust(6, '0')) if fraction else 0,
+        tz)
 
 
 def utc(dt):
@@ -2,15 +2,26 @@ from collections import namedtuple
 import re
 import datetime
 
-from dateutil import parser
 import pytz
 
+from . import timeseries
+from .database import aggregations
+from .timeutils import parse_iso
+
 RESERVED_KEYWORDS = (
     '_timestamp',
     '_id'
 )
 VALID_BUCKET_RE = re.compile(r'^[a-z][a-z0-9_]+$')
 VALID_KEY_RE = re.compile(r'^[a-z_][a-z0-9_]+$')
+WHITESPACE_RE = re.compile(r'\s')
+DATETIME_FORMAT_RE = re.compile(
+    "[0-9]{4}-[0-9]{2}-[0-9]{2}"
+    "T[0-9]{2}:[0-9]{2}:[0-9]{2}"
+    "(?:[+-][0-9]{2}:?[0-9]{2}|Z)"
+)
+SORT_BY_RE = re.compile(r'^.+:(ascending|descending)$')
+PERIODS = ['hour', 'day', 'week', 'month', 'quarter', 'year']
 
 
 def bucket_name_is_valid(bucket_name):
@@ -42,7 +53,7 @@ def value_is_valid(value):
 def value_is_valid_id(value):
     if not isinstance(value, basestring):
         return False
-    if re.compile('\s').search(value):
+    if WHITESPACE_RE.search(value):
         return False
     return len(value) > 0
 
@@ -54,19 +65,14 @@ def value_is_valid_datetime_string(value):
 
 def _is_real_date(value):
     try:
-        parser.parse(value).astimezone(pytz.UTC)
+        parse_iso(value).astimezone(pytz.UTC)
         return True
     except ValueError:
         return False
 
 
 def _is_valid_format(value):
-    time_pattern = re.compile(
-        "[0-9]{4}-[0-9]{2}-[0-9]{2}"
-        "T[0-9]{2}:[0-9]{2}:[0-9]{2}"
-        "(?:[+-][0-9]{2}:?[0-9]{2}|Z)"
-    )
-    return bool(time_pattern.match(value))
+    return bool(DATETIME_FORMAT_RE.match(value))
 
 
 ## Validation Result
@@ -84,14 +90,15 @@ def invalid(message):
 
 ## Record Validation
 
+_KEY_ERRORS_SIZE = 4096
+_key_errors = {}
+
+
 def validate_record_data(data):
     for key, value in data.items():
-        if not key_is_valid(key):
-            return invalid('{0} is not a valid key'.format(key))
-
-        if key_is_internal(key) and not key_is_reserved(key):
-            return invalid(
-                '{0} is not a recognised internal field'.format(key))
+        message = _key_error(key)
+        if message:
+            return invalid(message)
 
         if not value_is_valid(value):
             return invalid('{0} has an invalid value'.format(key))
@@ -106,6 +113,23 @@ def validate_record_data(data):
     return valid()
 
 
+def _key_error(key):
+    """Check a record key, memoized as every record repeats the same keys"""
+    message = _key_errors.get(key)
+    if message is None:
+        if not key_is_valid(key):
+            message = '{0} is not a valid key'.format(key)
+        elif key_is_internal(key) and not key_is_reserved(key):
+            message = '{0} is not a recognised internal field'.format(key)
+        else:
+            message = ''
+
+        if len(_key_errors) >= _KEY_ERRORS_SIZE:
+            _key_errors.clear()
+        _key_errors[key] = message
+    return message
+
+
 ## Query Validation
 
 class Validator(object):
@@ -138,8 +162,8 @@ class MultiValueValidator(Validator):
 
 
 class ParameterValidator(Validator):
-    def __init__(self, request_args):
-        self.allowed_parameters = set([
+    def __init__(self, request_args, allowed_parameters=None):
+        self.allowed_parameters = set(allowed_parameters or [
             'start_at',
             'end_at',
             'filter_by',
@@ -147,7 +171,9 @@ class ParameterValidator(Validator):
             'group_by',
             'sort_by',
             'limit',
-            'collect'
+            'collect',
+            'after',
+            'fields'
         ])
         super(ParameterValidator, self).__init__(request_args)
 
@@ -231,7 +257,7 @@ class ParameterMustBeOneOfTheseValidator(Validator):
 
 class SortByValidator(Validator):
     def _unrecognised_direction(self, sort_by):
-        return not re.match(r'^.+:(ascending|descending)$', sort_by)
+        return not SORT_BY_RE.match(sort_by)
 
     def validate(self, request_args, context):
         if 'sort_by' in request_args:
@@ -262,11 +288,14 @@ class GroupByValidator(Validator):
 
 class ParamDependencyValidator(Validator):
     def validate(self, request_args, context):
+        depends_on = context['depends_on']
+        if isinstance(depends_on, basestring):
+            depends_on = [depends_on]
         if context['param_name'] in request_args:
-            if context['depends_on'] not in request_args:
+            if not any(param in request_args for param in depends_on):
                 self.add_error(
                     '%s can be use only with %s'
-                    % (context['param_name'], context['depends_on']))
+                    % (context['param_name'], ' or '.join(depends_on)))
 
 
 class CollectValidator(Validator):
@@ -277,15 +306,47 @@ class CollectValidator(Validator):
             validate_field_value=self.validate_field_value)
 
     def validate_field_value(self, value, request_args, _):
-        if not key_is_valid(value):
+        field, _, method = value.partition(':')
+        if not key_is_valid(field):
             self.add_error('Cannot collect an invalid field name')
-        if value.startswith('_'):
+        if field.startswith('_'):
             self.add_error('Cannot collect internal fields, '
                            'internal fields start '
                            'with an underscore')
-        if value == request_args.get('group_by'):
+        if field == request_args.get('group_by'):
             self.add_error("Cannot collect by a field that is "
                            "used for group_by")
+        if method and not aggregations.is_method(method):
+            self.add_error("collect method must be one of {0} "
+                           "or a percentile such as p95".format(
+                               str(aggregations.METHODS)))
+
+
+class PaginationValidator(Validator):
+    def validate(self, request_args, context):
+        if 'after' in request_args:
+            if 'group_by' in request_args or 'period' in request_args \
+                    or 'sort_by' in request_args:
+                self.add_error('after can only be used for raw queries '
+                               'sorted by time')
+
+
+class FieldsValidator(Validator):
+    def validate(self, request_args, context):
+        if 'fields' in request_args:
+            if 'group_by' in request_args or 'period' in request_args:
+                self.add_error('fields can only be used for raw queries')
+        MultiValueValidator(
+            request_args,
+            param_name='fields',
+            validate_field_value=self.validate_field_value)
+
+    def validate_field_value(self, value, request_args, _):
+        if not key_is_valid(value):
+            self.add_error('Cannot select an invalid field name')
+        if key_is_internal(value) and not key_is_reserved(value):
+            self.add_error('Cannot select internal fields other than '
+                           '_timestamp and _id')
 
 
 class RawQueryValidator(Validator):
@@ -308,8 +369,8 @@ def _is_valid_date(string):
 class TimeSpanValidator(Validator):
     def validate(self, request_args, context):
         if self._is_valid_date_query(request_args):
-            start_at = parser.parse(request_args['start_at'])
-            end_at = parser.parse(request_args['end_at'])
+            start_at = parse_iso(request_args['start_at'])
+            end_at = parse_iso(request_args['end_at'])
             delta = end_at - start_at
             if delta.days < context['length']:
                 self.add_error('The minimum time span for a query is 7 days')
@@ -323,7 +384,7 @@ class MidnightValidator(Validator):
     def validate(self, request_args, context):
         timestamp = request_args.get(context['param_name'])
         if _is_valid_date(timestamp):
-            dt = parser.parse(timestamp).astimezone(pytz.UTC)
+            dt = parse_iso(timestamp).astimezone(pytz.UTC)
             if dt.time() != datetime.time(0):
                 self.add_error('%s must be midnight' % context['param_name'])
 
@@ -333,7 +394,7 @@ class MondayValidator(Validator):
         if request_args.get('period') == 'week':
             timestamp = request_args.get(context['param_name'])
             if _is_valid_date(timestamp):
-                if (parser.parse(timestamp)).weekday() != 0:
+                if parse_iso(timestamp).weekday() != 0:
                     self.add_error('%s must be a monday'
                                    % context['param_name'])
 
@@ -344,46 +405,115 @@ class FirstOfMonthValidator(Validator):
         if request_args.get('period') == 'month':
             timestamp = request_args.get(context['param_name'])
             if _is_valid_date(timestamp):
-                if (parser.parse(timestamp)).day != 1:
+                if parse_iso(timestamp).day != 1:
                     self.add_error('\'%s\' must be the first of the month for '
                                    'period=month queries'
                                    % context['param_name'])
 
 
-def validate_query_args(request_args, raw_queries_allowed=False):
-    validators = [
-        ParameterValidator(request_args),
-        PeriodQueryValidator(request_args),
-        DatetimeValidator(request_args, param_name='start_at'),
-        DatetimeValidator(request_args, param_name='end_at'),
-        FilterByValidator(request_args),
-        ParameterMustBeOneOfTheseValidator(
-            request_args,
-            param_name='period',
-            must_be_one_of_these=['week', 'month']
-        ),
-        SortByValidator(request_args),
-        GroupByValidator(request_args),
-        PositiveIntegerValidator(request_args, param_name='limit'),
-        ParamDependencyValidator(request_args, param_name='collect',
-                                 depends_on='group_by'),
-        CollectValidator(request_args),
-    ]
-
-    if not raw_queries_allowed:
-        validators += [
-            RawQueryValidator(request_args),
-            TimeSpanValidator(request_args, length=7),
-            MidnightValidator(request_args, param_name='start_at'),
-            MidnightValidator(request_args, param_name='end_at'),
-            MondayValidator(request_args, param_name="start_at"),
-            MondayValidator(request_args, param_name="end_at"),
-            FirstOfMonthValidator(request_args, param_name="start_at"),
-            FirstOfMonthValidator(request_args, param_name="end_at")
-        ]
-
-    for validator in validators:
+class PeriodStartValidator(Validator):
+    def validate(self, request_args, context):
+        period = timeseries.PERIODS.get(request_args.get('period'))
+        if period:
+            timestamp = request_args.get(context['param_name'])
+            if _is_valid_date(timestamp):
+                date = parse_iso(timestamp)
+                if period.start(date).date() != date.date():
+                    self.add_error('\'%s\' must be the start of a %s for '
+                                   'period=%s queries'
+                                   % (context['param_name'], period.name,
+                                      period.name))
+
+
+# Validators are listed as a class and its context so that they are only
+# built, and so run, until the first one fails
+QUERY_VALIDATORS = [
+    (ParameterValidator, {}),
+    (PeriodQueryValidator, {}),
+    (DatetimeValidator, {'param_name': 'start_at'}),
+    (DatetimeValidator, {'param_name': 'end_at'}),
+    (FilterByValidator, {}),
+    (ParameterMustBeOneOfTheseValidator, {
+        'param_name': 'period',
+        'must_be_one_of_these': PERIODS,
+    }),
+    (SortByValidator, {}),
+    (GroupByValidator, {}),
+    (PositiveIntegerValidator, {'param_name': 'limit'}),
+    (ParamDependencyValidator, {'param_name': 'collect',
+                                'depends_on': ['group_by', 'period']}),
+    (CollectValidator, {}),
+    (ParamDependencyValidator, {'param_name': 'after',
+                                'depends_on': 'limit'}),
+    (PaginationValidator, {}),
+    (FieldsValidator, {}),
+]
+
+RESTRICTED_QUERY_VALIDATORS = [
+    (RawQueryValidator, {}),
+    (TimeSpanValidator, {'length': 7}),
+    (MidnightValidator, {'param_name': 'start_at'}),
+    (MidnightValidator, {'param_name': 'end_at'}),
+    (MondayValidator, {'param_name': 'start_at'}),
+    (MondayValidator, {'param_name': 'end_at'}),
+    (FirstOfMonthValidator, {'param_name': 'start_at'}),
+    (FirstOfMonthValidator, {'param_name': 'end_at'}),
+    (PeriodStartValidator, {'param_name': 'start_at'}),
+    (PeriodStartValidator, {'param_name': 'end_at'}),
+]
+
+
+def first_error(request_args, validators):
+    """Run validators in order, returning the first error found"""
+    for validator_class, context in validators:
+        validator = validator_class(request_args, **context)
         if validator.invalid():
             return validator.errors[0]
 
     return valid()
+
+
+def validate_query_args(request_args, raw_queries_allowed=False):
+    validators = QUERY_VALIDATORS
+    if not raw_queries_allowed:
+        validators = validators + RESTRICTED_QUERY_VALIDATORS
+
+    return first_error(request_args, validators)
+
+
+## Partial Query Validation
+
+PARTIAL_DEFINITION_VALIDATORS = [
+    (ParameterValidator, {'allowed_parameters': ['period', 'group_by']}),
+    (ParameterMustBeOneOfTheseValidator, {
+        'param_name': 'period',
+        'must_be_one_of_these': PERIODS,
+    }),
+    (GroupByValidator, {}),
+]
+
+PARTIAL_QUERY_VALIDATORS = [
+    (ParameterValidator, {'allowed_parameters': ['start_at', 'end_at']}),
+    (PeriodQueryValidator, {}),
+    (DatetimeValidator, {'param_name': 'start_at'}),
+    (DatetimeValidator, {'param_name': 'end_at'}),
+]
+
+
+def validate_partial_definition(definition):
+    if not isinstance(definition, dict):
+        return invalid('A partial query must be defined by a JSON object')
+
+    if 'period' not in definition and 'group_by' not in definition:
+        return invalid('A partial query must have a period or group_by')
+
+    for param_name in ['period', 'group_by']:
+        if param_name in definition and \
+                not isinstance(definition[param_name], basestring):
+            return invalid('{0} must be a string'.format(param_name))
+
+    return first_error(definition, PARTIAL_DEFINITION_VALIDATORS)
+
+
+def validate_partial_query_args(request_args):
+    return first_error(request_args, PARTIAL_QUERY_VALIDATORS)
@@ -13,5 +13,8 @@ if os.getenv('FLASK_ENV', 'development') != 'development':
     app.config.from_envvar('BACKDROP_WRITE_SETTINGS')
 
 db = extensions.Database(app)
+group_commit = extensions.GroupCommit(app)
+spool = extensions.Spool(app)
+metrics = extensions.Metrics(app)
 
 from . import views
\ No newline at end of file
@@ -1,4 +1,41 @@
 SINGLE_SIGN_ON = True
 SECRET_KEY = 'something unique and secret'
 OAUTH_CLIENT_ID = 'oauth-client-id'
-OAUTH_CLIENT_SECRET = 'oauth-client-secret'
\ No newline at end of file
+OAUTH_CLIENT_SECRET = 'oauth-client-secret'
+
+# Parse and store uploads STREAMING_INGEST_BATCH_RECORDS at a time rather
+# than reading the whole body first. An invalid record then fails the
+# upload after the batches before it are stored, and the error response
+# has their counts.
+STREAMING_INGEST = False
+STREAMING_INGEST_BATCH_RECORDS = 1000
+MAX_CONTENT_LENGTH = 256 * 1024 * 1024
+
+# eg. {'w': 'majority', 'wtimeout': 5000} to wait for replication
+MONGO_WRITE_CONCERN = {'w': 1}
+
+# Store a digest of each record and skip records with an _id whose
+# data has not changed, so resent records keep their _updated_at
+SKIP_UNCHANGED_RECORDS = False
+
+# Store the records of concurrent requests to a bucket in one bulk write
+# of up to GROUP_COMMIT_MAX_RECORDS, waiting at most
+# GROUP_COMMIT_MAX_WAIT_MS for it to fill. Needs a threaded server.
+GROUP_COMMIT = False
+GROUP_COMMIT_MAX_RECORDS = 1000
+GROUP_COMMIT_MAX_WAIT_MS = 5
+
+# None, 'fallback' to spool records to disk while the database is
+# unavailable or 'async' to always spool them, see backdrop.spool.
+# SPOOL_FSYNC is 'always', 'interval' or 'never'. Replaying a batch that
+# fails with a database error other than a lost connection is retried
+# SPOOL_REPLAY_ATTEMPTS times before it is moved to a dead letter file.
+SPOOL = None
+SPOOL_PATH = '/tmp/backdrop-spool'
+SPOOL_FSYNC = 'always'
+SPOOL_FSYNC_INTERVAL = 1.0
+SPOOL_MAX_BYTES = 1024 * 1024 * 1024
+SPOOL_SEGMENT_BYTES = 64 * 1024 * 1024
+SPOOL_BATCH_RECORDS = 1000
+SPOOL_DRAIN_INTERVAL = 1.0
+SPOOL_REPLAY_ATTEMPTS = 10
@@ -1,9 +1,13 @@
-from flask import request, jsonify
+import itertools
+
+from flask import abort, request, jsonify
 from flask_negotiate import consumes
 
-from . import app, db
-from .. import record, csvutils
+from . import app, db, spool
+from .. import metrics, record, csvutils, jsonutils
+from ..bucket import PartialNotFoundError
 from ..errors import ParseError, ValidationError
+from ..spool import SpoolFullError
 
 
 @app.route('/_status')
@@ -11,23 +15,92 @@ def status():
     return "write status"
 
 
+@app.route('/_status/database')
+def database_status():
+    return jsonify(**db.stats())
+
+
+@app.route('/_status/spool')
+def spool_status():
+    return jsonify(**spool.stats())
+
+
+@app.route('/_metrics')
+def metrics_export():
+    body = metrics.render()
+    if body is None:
+        abort(404)
+    return app.response_class(body, mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/<bucket_name>', methods=['POST'])
 @consumes('application/json', 'text/csv')
 @db.load_bucket
 def store(bucket):
-    try:
+    if request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        abort(413)
+
+    with metrics.tags(bucket=bucket.name):
+        stored = {}
+        try:
+            with metrics.timer('write.store'):
+                for records in _record_batches():
+                    result = bucket.store(records)
+                    for outcome, count in result.items():
+                        stored[outcome] = stored.get(outcome, 0) + count
+                        metrics.incr('write.' + outcome, count)
+            return jsonify(status='ok', **stored)
+        except (ParseError, ValidationError) as e:
+            # Only streamed uploads can have stored batches by now
+            metrics.incr('write.invalid')
+            return jsonify(status='error',
+                           message=str(e), **stored), 400
+        except SpoolFullError as e:
+            metrics.incr('write.spool_full')
+            return jsonify(status='error',
+                           message=str(e), **stored), 503
+
+
+def _record_batches():
+    """Parse and validate the records of the request body in batches
+
+    Unless streaming, the whole body is a single batch, so nothing is
+    stored from a body with an invalid record.
+    """
+    size = None
+    if app.config['STREAMING_INGEST']:
+        size = app.config['STREAMING_INGEST_BATCH_RECORDS']
+
+    with metrics.timer('write.parse'):
         if request.mimetype == 'text/csv':
-            data = csvutils.parse(request.data)
+            records = record.parse_stream(csvutils.parse(request.stream))
+        elif app.config['STREAMING_INGEST']:
+            records = record.parse_stream(
+                jsonutils.iterload(request.stream))
         else:
-            data = request.json
+            records = iter(record.parse_all(request.json))
+        batch = list(itertools.islice(records, size))
+    yield batch
+
+    while size and len(batch) == size:
+        with metrics.timer('write.parse'):
+            batch = list(itertools.islice(records, size))
+        if batch:
+            yield batch
 
-        bucket.store(record.parse_all(data))
+
+@app.route('/<bucket_name>/<partial_name>', methods=['PUT', 'DELETE'])
+@db.load_bucket
+def partial_query(bucket, partial_name):
+    try:
+        if request.method == 'DELETE':
+            bucket.delete_partial(partial_name)
+        else:
+            bucket.define_partial(partial_name, request.json)
         return jsonify(status='ok')
     except (ParseError, ValidationError) as e:
         return jsonify(status='error',
                        message=str(e)), 400
-
-
-@app.route('/<bucket_name>/<partial_name>', methods=['POST', 'PUT', 'DELETE'])
-def create_partial(bucket_name, partial_name):
-    pass
+    except PartialNotFoundError as e:
+        return jsonify(status='error',
+                       message=str(e)), 404
@@ -0,0 +1,12 @@
+"""End to end benchmarks for backdrop
+
+Run with::
+
+    python -m benchmarks.run --driver backdrop.database.memory \\
+        --output results.json [--compare previous.json]
+
+Requests go through the combined WSGI application in backdrop.all, so
+the timings include parsing, validation, the database driver and
+response rendering. The MongoDB driver writes to the backdrop_benchmark
+database, drop it between runs to keep results comparable.
+"""
@@ -0,0 +1,61 @@
+"""Deterministic synthetic buckets
+
+The same spec always produces the same records, so runs against different
+versions of the code can be compared.
+"""
+import bisect
+import datetime
+import random
+from collections import namedtuple
+
+import pytz
+
+
+START_AT = datetime.datetime(2013, 1, 7, tzinfo=pytz.UTC)
+
+
+BucketSpec = namedtuple('BucketSpec', 'records fields cardinality days seed')
+
+
+def field_names(spec):
+    return ['field_{0}'.format(i) for i in range(spec.fields)]
+
+
+def field_value(index):
+    return 'value_{0}'.format(index)
+
+
+def generate(spec):
+    """Yield the records of a bucket as they would be posted
+
+    Field values follow a Zipf distribution over `cardinality` values,
+    as most real buckets have a few common values and a long tail.
+    Timestamps are spread evenly over `days` days.
+    """
+    rng = random.Random(spec.seed)
+    choose = _zipf_chooser(rng, spec.cardinality)
+    names = field_names(spec)
+    seconds = spec.days * 24 * 60 * 60
+
+    for _ in xrange(spec.records):
+        timestamp = START_AT + datetime.timedelta(
+            seconds=rng.randrange(seconds))
+        record = {
+            '_timestamp': timestamp.isoformat(),
+            'value': rng.randint(0, 1000),
+        }
+        for name in names:
+            record[name] = field_value(choose())
+        yield record
+
+
+def _zipf_chooser(rng, cardinality):
+    cumulative, total = [], 0.0
+    for rank in range(1, cardinality + 1):
+        total += 1.0 / rank
+        cumulative.append(total)
+
+    def choose():
+        return bisect.bisect_left(cumulative, rng.random() * total)
+
+    return choose
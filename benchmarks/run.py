@@ -0,0 +1,253 @@
+"""Benchmark ingest and queries through the backdrop WSGI application"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import urllib
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from . import generator
+
+
+BUCKET = 'benchmark'
+
+SCENARIOS = ['ingest', 'raw', 'grouped', 'period', 'period_grouped']
+
+
+def load_application(driver, settings=None):
+    """Import backdrop.all configured for the benchmark
+
+    All three apps share one database so that records written through
+    the write app can be read back through the read app, even with a
+    driver that keeps its data in process.
+    """
+    fd, path = tempfile.mkstemp(suffix='.py')
+    with os.fdopen(fd, 'w') as settings_file:
+        settings_file.write(
+            "DATABASE_DRIVER = {0!r}\n"
+            "DATABASE_NAME = 'backdrop_benchmark'\n"
+            "RAW_QUERIES_ALLOWED = {{{1!r}: True}}\n".format(driver, BUCKET))
+        if settings:
+            with open(settings) as extra:
+                settings_file.write(extra.read())
+
+    os.environ['FLASK_ENV'] = 'benchmark'
+    for name in ['BACKDROP_SETTINGS', 'BACKDROP_READ_SETTINGS',
+                 'BACKDROP_WRITE_SETTINGS', 'BACKDROP_ADMIN_SETTINGS']:
+        os.environ[name] = path
+
+    from backdrop.all import admin_app, read_app, write_app, application
+    os.remove(path)
+
+    database = read_app.extensions['backdrop.database']
+    for app in [admin_app, write_app]:
+        app.extensions['backdrop.database'] = database
+
+    return application
+
+
+class Benchmark(object):
+    def __init__(self, application, spec, batch_size, iterations):
+        self.client = Client(application, BaseResponse)
+        self.spec = spec
+        self.batch_size = batch_size
+        self.iterations = iterations
+        self.rng = random.Random(spec.seed)
+
+    def run(self, scenarios):
+        results = {}
+        for scenario in scenarios:
+            results[scenario] = getattr(self, scenario)()
+        return results
+
+    def ingest(self):
+        timings, batch = [], []
+        for record in generator.generate(self.spec):
+            batch.append(record)
+            if len(batch) == self.batch_size:
+                timings.append(self._post(batch))
+                batch = []
+        if batch:
+            timings.append(self._post(batch))
+
+        result = summarize(timings)
+        result['records_per_second'] = \
+            self.spec.records / sum(timings) if timings else 0
+        return result
+
+    def raw(self):
+        return self._queries(lambda: dict(
+            self._time_range(),
+            filter_by=self._filter(),
+            limit=100))
+
+    def grouped(self):
+        return self._queries(lambda: dict(
+            group_by=self._field(),
+            collect='value'))
+
+    def period(self):
+        return self._queries(lambda: dict(
+            self._week_range(),
+            period='week'))
+
+    def period_grouped(self):
+        return self._queries(lambda: dict(
+            self._week_range(),
+            period='week',
+            group_by=self._field()))
+
+    def _post(self, records):
+        body = json.dumps(records)
+        started_at = time.time()
+        response = self.client.post('/write/' + BUCKET, data=body,
+                                    content_type='application/json')
+        elapsed = time.time() - started_at
+        _check(response)
+        return elapsed
+
+    def _queries(self, make_args):
+        timings = []
+        for _ in range(self.iterations):
+            url = '/read/{0}?{1}'.format(BUCKET, urllib.urlencode(make_args()))
+            started_at = time.time()
+            response = self.client.get(
+                url, headers=[('Accept', 'application/json')])
+            response.data  # read all of a streamed body
+            timings.append(time.time() - started_at)
+            _check(response)
+        return summarize(timings)
+
+    def _field(self):
+        return self.rng.choice(generator.field_names(self.spec))
+
+    def _filter(self):
+        return '{0}:{1}'.format(
+            self._field(),
+            generator.field_value(self.rng.randrange(self.spec.cardinality)))
+
+    def _time_range(self):
+        start = self.rng.randrange(self.spec.days)
+        end = self.rng.randint(start + 1, self.spec.days)
+        return {
+            'start_at': _day(start).isoformat(),
+            'end_at': _day(end).isoformat(),
+        }
+
+    def _week_range(self):
+        weeks = max(self.spec.days // 7, 1)
+        start = self.rng.randrange(weeks)
+        end = self.rng.randint(start + 1, weeks)
+        return {
+            'start_at': _day(start * 7).isoformat(),
+            'end_at': _day(end * 7).isoformat(),
+        }
+
+
+def _day(offset):
+    return generator.START_AT + datetime.timedelta(days=offset)
+
+
+def _check(response):
+    if response.status_code != 200:
+        raise RuntimeError('{0} {1}'.format(response.status, response.data))
+
+
+def summarize(timings):
+    """Throughput and latency percentiles of a list of request timings"""
+    if not timings:
+        return {'requests': 0}
+    ordered = sorted(timings)
+    total = sum(ordered)
+    return {
+        'requests': len(ordered),
+        'seconds': total,
+        'requests_per_second': len(ordered) / total if total else 0,
+        'mean_ms': total / len(ordered) * 1000,
+        'p50_ms': percentile(ordered, 50) * 1000,
+        'p99_ms': percentile(ordered, 99) * 1000,
+    }
+
+
+def percentile(ordered, percent):
+    """Nearest rank percentile of a sorted list"""
+    rank = int(round(percent / 100.0 * len(ordered) + 0.5)) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+def compare(previous, current):
+    """Report the change in latency and throughput from a previous run"""
+    lines = []
+    for scenario, result in sorted(current['results'].items()):
+        before = previous['results'].get(scenario)
+        if not before or not before.get('requests'):
+            continue
+        lines.append('{0:<16} p50 {1:>+7.1%}  p99 {2:>+7.1%}  '
+                     'req/s {3:>+7.1%}'.format(
+                         scenario,
+                         _change(before['p50_ms'], result['p50_ms']),
+                         _change(before['p99_ms'], result['p99_ms']),
+                         _change(before['requests_per_second'],
+                                 result['requests_per_second'])))
+    return '\n'.join(lines)
+
+
+def _change(before, after):
+    return (after - before) / before if before else 0.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark backdrop against synthetic data')
+    parser.add_argument('--driver', default='backdrop.database.memory')
+    parser.add_argument('--settings',
+                        help='a settings file applied to all apps')
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--fields', type=int, default=3)
+    parser.add_argument('--cardinality', type=int, default=50)
+    parser.add_argument('--days', type=int, default=84)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=100,
+                        help='requests per query scenario')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='run only these scenarios, ingest is '
+                             'needed to load the data')
+    parser.add_argument('--output', help='write results as JSON here')
+    parser.add_argument('--compare', help='results of a previous run')
+    args = parser.parse_args(argv)
+
+    spec = generator.BucketSpec(
+        args.records, args.fields, args.cardinality, args.days, args.seed)
+    benchmark = Benchmark(load_application(args.driver, args.settings),
+                          spec, args.batch_size, args.iterations)
+
+    results = {
+        'driver': args.driver,
+        'spec': spec._asdict(),
+        'batch_size': args.batch_size,
+        'python': platform.python_version(),
+        'results': benchmark.run(args.scenario or SCENARIOS),
+    }
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            sys.stderr.write(compare(json.load(previous), results) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,7 @@ import backdrop
 requires = [
     "Flask==0.9",
     "Flask-Negotiate",
-    "pymongo==2.5",
+    "pymongo==2.7.2",
     "python-dateutil==2.1",
     "pytz==2013b",
 ]
@@ -25,7 +25,7 @@ setup(
     license='https://github.com/alphagov/backdrop/master/LICENCE.txt',
 
     # Package configuration
-    packages=find_packages(exclude=['tests*', 'features*']),
+    packages=find_packages(exclude=['tests*', 'features*', 'benchmarks*']),
     include_package_data=True,
     zip_safe=False,
     install_requires=requires,
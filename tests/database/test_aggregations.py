@@ -0,0 +1,32 @@
+import unittest
+
+from backdrop.database import aggregations
+
+
+class TestEmptyValues(unittest.TestCase):
+    def test_each_aggregation_has_the_value_of_no_records(self):
+        self.assertEqual(
+            aggregations.empty_values(['a', 'a:count_distinct', 'a:sum',
+                                       'a:mean', 'a:max', 'a:p99']),
+            {'a': [], 'a:count_distinct': 0, 'a:sum': 0, 'a:mean': None,
+             'a:max': None, 'a:p99': None})
+
+    def test_subgroups_have_no_values(self):
+        self.assertEqual(
+            aggregations.empty_values(['a', 'a:sum'], subgroups=True),
+            {'a:sum': 0})
+
+
+class TestCountDistinct(unittest.TestCase):
+    def setUp(self):
+        [self.count_distinct] = aggregations.parse(['a:count_distinct'])
+
+    def test_counts_from_the_database_are_used_as_they_are(self):
+        state = self.count_distinct.pop_state({'a:count_distinct': 3})
+        self.assertEqual(self.count_distinct.value(state), 3)
+
+    def test_values_are_merged_before_they_are_counted(self):
+        state = self.count_distinct.merge(
+            self.count_distinct.pop_state({'a:count_distinct': [1, 2]}),
+            self.count_distinct.pop_state({'a:count_distinct': [2, 3]}))
+        self.assertEqual(self.count_distinct.value(state), 3)
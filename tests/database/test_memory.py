@@ -0,0 +1,22 @@
+import unittest
+
+from backdrop.database.memory import Table
+
+
+class TestTable(unittest.TestCase):
+    def test_list_and_document_values_are_saved_and_replaced(self):
+        table = Table()
+        table.save({'_id': 'a', 'tags': ['x', 'y'], 'meta': {'k': 1}})
+        table.save({'_id': 'a', 'tags': ['z'], 'meta': {'k': 2}})
+
+        self.assertEqual(table.document(0),
+                         {'_id': 'a', 'tags': ['z'], 'meta': {'k': 2}})
+        self.assertNotIn('tags', table._value_indexes)
+        self.assertNotIn('meta', table._value_indexes)
+
+    def test_rows_are_found_by_indexed_value(self):
+        table = Table()
+        table.save({'_id': 'a', 'authority': 'x'})
+        table.save({'_id': 'b', 'authority': 'y'})
+
+        self.assertEqual(table.candidate_rows({'authority': 'y'}), [1])
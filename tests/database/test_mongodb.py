@@ -0,0 +1,353 @@
+import datetime
+import threading
+import time
+import unittest
+
+from pymongo.errors import AutoReconnect
+
+from backdrop import timeutils
+from backdrop.database import mongodb
+from backdrop.database.memory import MemoryDriver, Table
+from backdrop.database.mongodb import nested_merge, PartialStore, \
+    _replaced_docs
+from backdrop.query import Query
+from backdrop.record import parse_all
+
+
+class TestNestedMerge(unittest.TestCase):
+    def test_groups_by_list_and_document_values(self):
+        results = nested_merge(['tags', 'meta'], [], [
+            {'tags': ['a', 'b'], 'meta': {'k': 1}, '_count': 1},
+            {'tags': ['a', 'b'], 'meta': {'k': 2}, '_count': 2},
+            {'tags': ['c'], 'meta': {'k': 1}, '_count': 4},
+        ])
+
+        self.assertEqual([(group['tags'], group['_count'])
+                          for group in results],
+                         [(['a', 'b'], 3), (['c'], 4)])
+        self.assertEqual([subgroup['meta']
+                          for subgroup in results[0]['_subgroup']],
+                         [{'k': 1}, {'k': 2}])
+
+
+class StoredDocs(object):
+    """Answers find_by_ids from a dict of stored documents"""
+    def __init__(self, docs):
+        self._docs = docs
+
+    def find_by_ids(self, ids, fields):
+        return dict((_id, dict((field, self._docs[_id][field])
+                               for field in fields + ['_id']
+                               if field in self._docs[_id]))
+                    for _id in ids if _id in self._docs)
+
+
+class Counts(object):
+    """The bulk $inc and remove calls PartialStore makes, on a dict"""
+    def __init__(self):
+        self.counts = {}
+
+    def initialize_unordered_bulk_op(self):
+        return self
+
+    def find(self, spec):
+        self._group = tuple(spec['_id'].items())
+        self._upsert = False
+        return self
+
+    def upsert(self):
+        self._upsert = True
+        return self
+
+    def update(self, document):
+        if self._upsert or self._group in self.counts:
+            self.counts[self._group] = self.counts.get(self._group, 0) + \
+                document['$inc']['_count']
+
+    def execute(self):
+        pass
+
+    def remove(self, spec):
+        assert spec == {'_count': {'$lte': 0}}
+        for group, count in self.counts.items():
+            if count <= 0:
+                del self.counts[group]
+
+
+class TestPartialStore(unittest.TestCase):
+    def test_replaced_records_move_between_groups(self):
+        counts = Counts()
+        store = PartialStore(counts, None, 'authority')
+        store.add([{'_id': 1, 'authority': 'x'},
+                   {'_id': 2, 'authority': 'x'}])
+
+        docs = [{'_id': 1, 'authority': 'y'}, {'_id': 3, 'authority': 'y'}]
+        replaced = _replaced_docs(
+            StoredDocs({1: {'_id': 1, 'authority': 'x'},
+                        2: {'_id': 2, 'authority': 'x'}}),
+            docs, ['authority'])
+        store.add(docs)
+        store.remove(replaced)
+
+        self.assertEqual(counts.counts, {(('authority', 'x'),): 1,
+                                         (('authority', 'y'),): 2})
+
+    def test_groups_that_lose_every_record_are_removed(self):
+        counts = Counts()
+        store = PartialStore(counts, None, 'authority')
+        store.add([{'_id': 1, 'authority': 'x'}])
+
+        docs = [{'_id': 1, 'authority': 'y'}]
+        replaced = _replaced_docs(
+            StoredDocs({1: {'_id': 1, 'authority': 'x'}}), docs,
+            ['authority'])
+        store.add(docs)
+        store.remove(replaced)
+
+        self.assertEqual(counts.counts, {(('authority', 'y'),): 1})
+
+
+class Documents(object):
+    """The find and update calls Database makes, on a dict of documents"""
+    def __init__(self, *docs):
+        self.docs = dict((doc['_id'], doc) for doc in docs)
+
+    def find_one(self, spec, **kwargs):
+        if not isinstance(spec, dict):
+            spec = {'_id': spec}
+        return next(iter(self.find(spec)), None)
+
+    def find(self, spec, **kwargs):
+        return [dict(doc) for doc in self.docs.values()
+                if all(_matches(doc.get(field), condition)
+                       for field, condition in spec.items())]
+
+    def update(self, spec, document, upsert=False, multi=False):
+        matched = [self.docs[doc['_id']] for doc in self.find(spec)]
+        if not matched and upsert:
+            matched = [self.docs.setdefault(spec['_id'], {'_id': spec['_id']})]
+        for doc in matched if multi else matched[:1]:
+            for field, value in document.get('$inc', {}).items():
+                doc[field] = doc.get(field, 0) + value
+            doc.update(document.get('$set', {}))
+
+
+def _matches(value, condition):
+    if isinstance(condition, dict):
+        if '$ne' in condition:
+            return value != condition['$ne']
+        return value is not None and value < condition['$lt']
+    return value == condition
+
+
+class Rebuilds(object):
+    """Stands in for the PartialStore of every partial"""
+    def __init__(self, error=None):
+        self.rebuilt = threading.Event()
+        self._error = error
+
+    def rebuild(self, driver):
+        if self._error:
+            raise self._error
+        self.rebuilt.set()
+
+    def add(self, docs):
+        raise AutoReconnect('lost')
+
+    keys = ['authority']
+
+
+class FakeDatabase(mongodb.Database):
+    _poll_interval = 0.01
+
+    def __init__(self, partial_store=None):
+        super(FakeDatabase, self).__init__('localhost', 27017, 'test')
+        self.writes = Documents()
+        self.definitions = Documents()
+        self.table = Table()
+        self.partial_store = partial_store or Rebuilds()
+
+    @property
+    def _writes(self):
+        return self.writes
+
+    @property
+    def _partial_definitions(self):
+        return self.definitions
+
+    def _driver(self, bucket_name):
+        return MemoryDriver(self.table, threading.RLock())
+
+    def _partial_store(self, bucket_name, partial_name, period, group_by):
+        return self.partial_store
+
+    def unfinished_writes(self):
+        writes = self.writes.find_one('foo')
+        return writes['started'] - writes['finished']
+
+
+def _in_thread(function, *args):
+    thread = threading.Thread(target=function, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class TestPartialRebuild(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeDatabase()
+
+    def define(self, **definition):
+        definition.setdefault('rebuilding_at', None)
+        self.db.definitions.docs['foo.bar'] = dict(
+            _id='foo.bar', bucket='foo', name='bar', period=None,
+            group_by='authority', **definition)
+
+    def test_writes_wait_for_a_rebuild(self):
+        self.define(rebuilding_at=timeutils.now())
+        thread = _in_thread(self.db._start_write, 'foo')
+
+        time.sleep(0.05)
+        self.assertTrue(thread.is_alive())
+        self.db.definitions.docs['foo.bar']['rebuilding_at'] = None
+        thread.join(1)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.db.unfinished_writes(), 1)
+
+    def test_writes_mark_a_rebuild_that_timed_out_stale(self):
+        self.define(rebuilding_at=timeutils.now() - datetime.timedelta(
+            seconds=self.db._rebuild_timeout + 1))
+
+        self.db._start_write('foo')
+
+        definition = self.db.definitions.find_one('foo.bar')
+        self.assertIsNone(definition['rebuilding_at'])
+        self.assertTrue(definition['stale'])
+
+    def test_rebuild_waits_for_writes_in_progress(self):
+        self.db._start_write('foo')
+        thread = _in_thread(self.db.define_partial, 'foo', 'bar',
+                            Query.create(group_by='authority'))
+
+        time.sleep(0.05)
+        self.assertFalse(self.db.partial_store.rebuilt.is_set())
+        self.assertTrue(
+            self.db.definitions.find_one('foo.bar')['rebuilding_at'])
+        self.db.writes.update({'_id': 'foo'}, {'$inc': {'finished': 1}})
+        thread.join(1)
+
+        self.assertTrue(self.db.partial_store.rebuilt.is_set())
+        definition = self.db.definitions.find_one('foo.bar')
+        self.assertIsNone(definition['rebuilding_at'])
+        self.assertFalse(definition['stale'])
+
+    def test_unfinished_writes_are_taken_as_lost(self):
+        self.db._write_timeout = 0.05
+        self.db._start_write('foo')
+
+        self.db.define_partial('foo', 'bar', Query.create(group_by='a'))
+
+        self.assertTrue(self.db.partial_store.rebuilt.is_set())
+        self.assertEqual(self.db.unfinished_writes(), 0)
+
+    def test_failed_rebuild_leaves_the_partial_stale(self):
+        self.db.partial_store = Rebuilds(error=AutoReconnect('lost'))
+
+        with self.assertRaises(AutoReconnect):
+            self.db.define_partial('foo', 'bar', Query.create(group_by='a'))
+
+        definition = self.db.definitions.find_one('foo.bar')
+        self.assertIsNone(definition['rebuilding_at'])
+        self.assertTrue(definition['stale'])
+
+    def test_failed_count_update_marks_the_partial_stale(self):
+        self.define(stale=False)
+        self.db._collection = lambda bucket_name: mongodb.Collection(
+            self.db._driver(bucket_name))
+
+        with self.assertRaises(AutoReconnect):
+            self.db.store('foo', parse_all([{'authority': 'x'}]))
+
+        self.assertTrue(self.db.definitions.find_one('foo.bar')['stale'])
+        self.assertEqual(self.db.unfinished_writes(), 0)
+
+    def test_stale_partials_group_the_raw_records(self):
+        self.define(stale=True)
+        for authority in ['x', 'x', 'y']:
+            self.db.table.save({'authority': authority})
+
+        rows = self.db.query_partial('foo', 'bar',
+                                     Query.create(group_by='authority'))
+
+        self.assertEqual([(row['authority'], row['_count']) for row in rows],
+                         [('x', 2), ('y', 1)])
+
+
+class TestSuggestedIndex(unittest.TestCase):
+    def test_group_by_fields_come_before_the_period(self):
+        self.assertEqual(
+            mongodb._suggested_index(
+                ['_timestamp', '_week_start_at', 'authority']),
+            ['authority', '_week_start_at', '_timestamp'])
+
+    def test_operators_are_left_out(self):
+        self.assertEqual(mongodb._suggested_index(['$or', '_timestamp']),
+                         ['_timestamp'])
+
+
+class Pipelines(object):
+    """Records the pipelines and group commands a MongoDriver runs"""
+    def __init__(self):
+        self.pipelines = []
+        self.finalize = None
+
+    def aggregate(self, pipeline, cursor):
+        self.pipelines.append(pipeline)
+        return []
+
+    def group(self, key, condition, initial, reduce, finalize):
+        self.finalize = finalize
+        return []
+
+
+class TestMongoDriverGroup(unittest.TestCase):
+    def test_single_key_groupings_count_distinct_values_in_the_database(self):
+        collection = Pipelines()
+        mongodb.MongoDriver(collection, 'aggregate').group(
+            ['authority'], {}, ['a:count_distinct', 'b:sum'])
+
+        [pipeline] = collection.pipelines
+        self.assertEqual(pipeline[-1], {"$project": {
+            "_id": 1, "_count": 1, "b:sum": 1,
+            "a:count_distinct": {"$size": "$a:count_distinct"}}})
+
+    def test_values_are_merged_for_groupings_with_subgroups(self):
+        collection = Pipelines()
+        mongodb.MongoDriver(collection, 'aggregate').group(
+            ['authority', '_week_start_at'], {}, ['a:count_distinct'])
+
+        [pipeline] = collection.pipelines
+        self.assertEqual(pipeline[-1].keys(), ["$group"])
+
+    def test_group_command_finalizes_single_key_groupings(self):
+        collection = Pipelines()
+        driver = mongodb.MongoDriver(collection, 'group')
+
+        driver.group(['authority'], {}, ['a:count_distinct'])
+        self.assertIn('Object.keys(out["a:count_distinct"]).length',
+                      str(collection.finalize))
+
+        driver.group(['authority', '_week_start_at'], {},
+                     ['a:count_distinct'])
+        self.assertIsNone(collection.finalize)
+
+
+class TestConnectionManager(unittest.TestCase):
+    def test_stats_set_the_configuration_apart(self):
+        stats = mongodb.ConnectionManager('localhost', 27017,
+                                          pool_size=10).stats()
+
+        self.assertFalse(stats['connected'])
+        self.assertEqual(stats['config']['pool_size'], 10)
+        self.assertNotIn('pool_size', stats)
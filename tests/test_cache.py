@@ -0,0 +1,28 @@
+import unittest
+
+from backdrop.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(2)
+        cache.set('a', 'A')
+        cache.set('b', 'B')
+        cache.get('a')
+        cache.set('c', 'C')
+
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 'C')
+
+    def test_entries_over_the_size_limit_are_not_cached(self):
+        cache = LRUCache(2, max_entry_size=3)
+        cache.set('a', 'long')
+
+        self.assertIsNone(cache.get('a'))
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = LRUCache(2, ttl=-1)
+        cache.set('a', 'A')
+
+        self.assertIsNone(cache.get('a'))
@@ -0,0 +1,33 @@
+import unittest
+
+from backdrop import csvutils
+from backdrop.errors import ParseError
+
+
+def parse(*lines):
+    return list(csvutils.parse(line + '\n' for line in lines))
+
+
+class TestParse(unittest.TestCase):
+    def test_rows_are_parsed_into_dicts(self):
+        self.assertEqual(parse('a,b', '1,2'), [{'a': u'1', 'b': u'2'}])
+
+    def test_comment_column_is_dropped(self):
+        self.assertEqual(parse('a,comment', '1,note'), [{'a': u'1'}])
+
+    def test_row_with_only_a_comment_is_skipped(self):
+        self.assertEqual(parse('a,comment', ',note', '1,'), [{'a': u'1'}])
+
+    def test_comment_lines_are_skipped(self):
+        self.assertEqual(parse('# about', 'a,b', '# more', '1,2'),
+                         [{'a': u'1', 'b': u'2'}])
+
+    def test_errors_give_the_line_counting_comment_lines(self):
+        with self.assertRaises(ParseError) as context:
+            parse('# about', 'a,b', '# more', '1,2', '1,2,3')
+        self.assertIn('Line 5 ', str(context.exception))
+
+    def test_errors_give_the_line_counting_blank_lines(self):
+        with self.assertRaises(ParseError) as context:
+            parse('a,b', '', '1')
+        self.assertIn('Line 3 ', str(context.exception))
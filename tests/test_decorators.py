@@ -0,0 +1,66 @@
+import datetime
+import unittest
+
+from flask import Flask
+import pytz
+
+from backdrop.bucket import Bucket
+from backdrop.database import memory
+from backdrop.decorators import conditional
+
+
+def create_app(db):
+    app = Flask(__name__)
+
+    @app.route('/<bucket_name>')
+    def view(bucket_name):
+        return conditional(lambda bucket, version: 'data')(
+            bucket=Bucket(db, bucket_name, False))
+
+    return app
+
+
+class TestConditional(unittest.TestCase):
+    def setUp(self):
+        self.db = memory.Database('test')
+        self.client = create_app(self.db).test_client()
+
+    def test_if_modified_since_is_compared_in_utc(self):
+        # A +01:00 time an hour after the same UTC time
+        self.db.bump_version('foo', datetime.datetime(
+            2013, 6, 1, 12, 0, 0, tzinfo=pytz.FixedOffset(60)))
+
+        response = self.client.get('/foo', headers={
+            'If-Modified-Since': 'Sat, 01 Jun 2013 11:30:00 GMT'})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get('/foo', headers={
+            'If-Modified-Since': 'Sat, 01 Jun 2013 10:30:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_write_in_the_second_of_if_modified_since_is_modified(self):
+        self.db.bump_version('foo', datetime.datetime(
+            2013, 6, 1, 12, 0, 0, 500000, tzinfo=pytz.utc))
+
+        response = self.client.get('/foo', headers={
+            'If-Modified-Since': 'Sat, 01 Jun 2013 12:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get('/foo', headers={
+            'If-Modified-Since': 'Sat, 01 Jun 2013 12:00:01 GMT'})
+        self.assertEqual(response.status_code, 304)
+
+    def test_if_none_match_takes_precedence(self):
+        self.db.bump_version('foo', datetime.datetime(2013, 6, 1))
+
+        response = self.client.get('/foo', headers={
+            'If-None-Match': '"stale"',
+            'If-Modified-Since': 'Sat, 01 Jun 2013 12:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_matching_etag_is_not_modified(self):
+        self.db.bump_version('foo', datetime.datetime(2013, 6, 1))
+        etag = self.client.get('/foo').headers['ETag']
+
+        response = self.client.get('/foo', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
@@ -0,0 +1,83 @@
+import threading
+import time
+import unittest
+
+from backdrop.groupcommit import GroupCommit
+
+
+class RecordingDatabase(object):
+    """Counts the records each batch passed to store_batches holds"""
+    def __init__(self, blocked=None):
+        self.stores = []
+        self._blocked = blocked
+
+    def store_batches(self, bucket_name, batches):
+        batches = [list(batch) for batch in batches]
+        self.stores.append([len(batch) for batch in batches])
+        if self._blocked is not None and len(self.stores) == 1:
+            self._blocked.wait(1)
+        return [{'inserted': len(batch), 'updated': 0, 'unchanged': 0}
+                for batch in batches]
+
+    def bump_version(self, bucket_name, updated_at):
+        pass
+
+
+def store_concurrently(group_commit, db, sizes):
+    results = {}
+
+    def store(index, size):
+        results[index] = group_commit.store(db, 'foo', range(size))
+
+    threads = [threading.Thread(target=store, args=(index, size))
+               for index, size in enumerate(sizes)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+class TestGroupCommit(unittest.TestCase):
+    def test_a_request_alone_does_not_wait(self):
+        db = RecordingDatabase()
+        started = time.time()
+
+        counts = GroupCommit(10, max_wait_ms=1000).store(db, 'foo', [1, 2])
+
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual(counts['inserted'], 2)
+
+    def test_requests_waiting_on_a_store_are_grouped(self):
+        blocked = threading.Event()
+        db = RecordingDatabase(blocked)
+        group_commit = GroupCommit(100, max_wait_ms=1000)
+        threads, results = store_concurrently(group_commit, db, [1])
+        time.sleep(0.05)
+        more_threads, more_results = store_concurrently(
+            group_commit, db, [1, 2, 3])
+        time.sleep(0.05)
+        blocked.set()
+        for thread in threads + more_threads:
+            thread.join(2)
+
+        self.assertEqual(db.stores[0], [1])
+        self.assertEqual(sorted(db.stores[1]), [1, 2, 3])
+        self.assertEqual(sorted(counts['inserted']
+                                for counts in more_results.values()),
+                         [1, 2, 3])
+
+    def test_batches_are_split_at_max_records(self):
+        blocked = threading.Event()
+        db = RecordingDatabase(blocked)
+        group_commit = GroupCommit(10, max_wait_ms=1000)
+        threads, _ = store_concurrently(group_commit, db, [1])
+        time.sleep(0.05)
+        more_threads, results = store_concurrently(
+            group_commit, db, [4] * 12)
+        time.sleep(0.05)
+        blocked.set()
+        for thread in threads + more_threads:
+            thread.join(2)
+
+        self.assertTrue(all(sum(store) <= 10 for store in db.stores))
+        self.assertEqual(sum(sum(store) for store in db.stores), 49)
+        self.assertEqual(len(results), 12)
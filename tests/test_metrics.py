@@ -0,0 +1,28 @@
+import unittest
+
+from flask import Flask
+
+from backdrop import extensions, metrics
+
+
+def create_app():
+    app = Flask(__name__)
+    app.config.update(METRICS='prometheus', PROMETHEUS_PREFIX='backdrop')
+    extensions.Metrics(app)
+    return app
+
+
+class TestMetrics(unittest.TestCase):
+    def test_apps_with_the_same_settings_keep_their_own_metrics(self):
+        read_app, write_app = create_app(), create_app()
+
+        with write_app.app_context():
+            metrics.incr('write.inserted')
+        with read_app.app_context():
+            self.assertNotIn('write_inserted', metrics.render())
+        with write_app.app_context():
+            self.assertIn('backdrop_write_inserted', metrics.render())
+
+    def test_metrics_outside_an_app_are_dropped(self):
+        metrics.incr('write.inserted')
+        self.assertIsNone(metrics.render())
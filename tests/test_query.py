@@ -0,0 +1,23 @@
+import unittest
+
+from werkzeug.datastructures import MultiDict
+
+from backdrop.query import Query
+
+
+class TestParse(unittest.TestCase):
+    def test_changing_a_parsed_query_does_not_change_the_next(self):
+        args = MultiDict([('filter_by', 'authority:x'),
+                          ('collect', 'value'),
+                          ('group_by', 'authority'),
+                          ('sort_by', 'authority:ascending')])
+        query = Query.parse(args)
+        query.filter_by[0][1] = 'y'
+        query.collect.append('other')
+        query.sort_by[1] = 'descending'
+
+        query = Query.parse(args)
+
+        self.assertEqual(query.filter_by, [['authority', 'x']])
+        self.assertEqual(query.collect, ['value'])
+        self.assertEqual(query.sort_by, ['authority', 'ascending'])
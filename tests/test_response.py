@@ -0,0 +1,38 @@
+import datetime
+import unittest
+
+import pytz
+
+from backdrop.query import Query
+from backdrop.response import build_period_response, \
+    build_period_group_response
+
+
+def week(day):
+    return datetime.datetime(2013, 1, day, tzinfo=pytz.utc)
+
+
+class TestFillMissingPeriods(unittest.TestCase):
+    def test_missing_periods_have_empty_aggregates(self):
+        query = Query.create(period='week', start_at=week(7),
+                             end_at=week(21), collect=['value:sum', 'value'])
+        response = build_period_response(query, [
+            {'_week_start_at': week(7), '_count': 1,
+             'value:sum': 4, 'value': [4]}])
+
+        missing = response.data()[1]
+        self.assertEqual((missing['_count'], missing['value:sum'],
+                          missing['value']), (0, 0, []))
+
+    def test_missing_subgroup_periods_have_their_aggregates(self):
+        query = Query.create(period='week', group_by='authority',
+                             start_at=week(7), end_at=week(21),
+                             collect=['value:count_distinct', 'value'])
+        response = build_period_group_response(query, [
+            {'authority': 'x', '_count': 1, 'value': [4], '_subgroup': [
+                {'_week_start_at': week(7), '_count': 1,
+                 'value:count_distinct': 1}]}])
+
+        missing = response.data()[0]['values'][1]
+        self.assertEqual(missing['value:count_distinct'], 0)
+        self.assertNotIn('value', missing)
@@ -0,0 +1,39 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from backdrop.database import memory
+from backdrop.query import Query
+from backdrop.record import parse_all
+from backdrop.spool import Spool
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.umask = os.umask(0o022)
+
+    def tearDown(self):
+        os.umask(self.umask)
+        shutil.rmtree(self.path)
+
+    def test_spooled_records_are_replayed(self):
+        spool = Spool(self.path, 'async')
+        spool.spool('foo', parse_all([{'value': 1}, {'value': 2}]))
+        db = memory.Database('test')
+
+        spool.drain(db)
+
+        self.assertEqual(sorted(doc['value'] for doc in
+                                db.query('foo', Query.create())), [1, 2])
+        self.assertEqual(spool.backlog_bytes(), 0)
+
+    def test_spool_files_can_be_read_by_others(self):
+        spool = Spool(self.path, 'async')
+        spool.spool('foo', parse_all([{'value': 1}]))
+
+        for name in os.listdir(self.path):
+            mode = stat.S_IMODE(os.stat(os.path.join(self.path, name)).st_mode)
+            self.assertEqual(mode, 0o644, name)
@@ -0,0 +1,20 @@
+import unittest
+
+from backdrop.validation import validate_partial_definition
+
+
+class TestValidatePartialDefinition(unittest.TestCase):
+    def test_valid_definition(self):
+        self.assertTrue(validate_partial_definition(
+            {'period': 'week', 'group_by': 'authority'}).is_valid)
+
+    def test_group_by_must_be_a_string(self):
+        for group_by in [5, None, ['authority'], {'a': 1}]:
+            result = validate_partial_definition({'group_by': group_by})
+            self.assertFalse(result.is_valid)
+            self.assertEqual(result.message, 'group_by must be a string')
+
+    def test_period_must_be_a_string(self):
+        result = validate_partial_definition({'period': ['week']})
+        self.assertFalse(result.is_valid)
+        self.assertEqual(result.message, 'period must be a string')
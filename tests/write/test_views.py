@@ -0,0 +1,110 @@
+import json
+import unittest
+
+from backdrop import metrics
+from backdrop.database import memory
+from backdrop.query import Query
+from backdrop.write import app
+
+
+class WriteAppTestCase(unittest.TestCase):
+    config = {}
+
+    def setUp(self):
+        self.db = memory.Database('test')
+        self._extensions = dict(app.extensions)
+        self._config = dict(app.config)
+        app.extensions['backdrop.database'] = self.db
+        app.config.update(self.config)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.extensions.clear()
+        app.extensions.update(self._extensions)
+        app.config.clear()
+        app.config.update(self._config)
+
+    def post(self, body, content_type='application/json'):
+        response = self.client.post('/foo', data=body,
+                                    content_type=content_type)
+        return response.status_code, json.loads(response.data)
+
+    def stored_values(self):
+        return sorted(doc['value']
+                      for doc in self.db.query('foo', Query.create()))
+
+
+class TestStore(WriteAppTestCase):
+    config = {'STREAMING_INGEST_BATCH_RECORDS': 1}
+
+    def test_records_are_stored(self):
+        status, body = self.post('[{"value": 1}, {"value": 2}]')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body['inserted'], 2)
+        self.assertEqual(self.stored_values(), [1, 2])
+
+    def test_parsing_and_storing_are_timed(self):
+        app.extensions['backdrop.metrics'] = metrics.PrometheusMetrics('t')
+        self.post('[{"value": 1}]')
+
+        with app.app_context():
+            exported = metrics.render()
+        for stage in ['write_parse', 'database_store', 'write_store']:
+            self.assertIn('t_{0}_seconds_count'.format(stage), exported)
+
+    def test_nothing_is_stored_from_a_body_with_an_invalid_record(self):
+        status, body = self.post('[{"value": 1}, {"_bad": 2}]')
+
+        self.assertEqual(status, 400)
+        self.assertEqual(self.stored_values(), [])
+
+    def test_nothing_is_stored_from_a_body_that_is_not_json(self):
+        response = self.client.post('/foo', data='[{"value": 1},]',
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stored_values(), [])
+
+    def test_nothing_is_stored_from_a_csv_body_with_a_bad_row(self):
+        status, body = self.post('value\n1\n2\n3,4\n', 'text/csv')
+
+        self.assertEqual(status, 400)
+        self.assertIn('Line 4 ', body['message'])
+        self.assertEqual(self.stored_values(), [])
+
+
+class TestStreamingStore(WriteAppTestCase):
+    config = {'STREAMING_INGEST': True, 'STREAMING_INGEST_BATCH_RECORDS': 2}
+
+    def test_records_are_stored_in_batches(self):
+        status, body = self.post(json.dumps(
+            [{"value": value} for value in range(5)]))
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body['inserted'], 5)
+        self.assertEqual(self.stored_values(), range(5))
+
+    def test_error_reports_the_batches_stored_before_it(self):
+        status, body = self.post(
+            '[{"value": 1}, {"value": 2}, {"value": 3}, {"_bad": 4}]')
+
+        self.assertEqual(status, 400)
+        self.assertEqual(body['inserted'], 2)
+        self.assertEqual(self.stored_values(), [1, 2])
+
+    def test_trailing_garbage_reports_what_was_stored(self):
+        status, body = self.post('[{"value": 1}, {"value": 2}] garbage')
+
+        self.assertEqual(status, 400)
+        self.assertEqual(body['inserted'], 2)
+
+
+class TestPartialQuery(WriteAppTestCase):
+    def test_group_by_that_is_not_a_string_is_rejected(self):
+        response = self.client.put('/foo/by_number',
+                                   data='{"group_by": 5}',
+                                   content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNone(self.db.partial_definition('foo', 'by_number'))